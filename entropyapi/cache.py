@@ -5,27 +5,62 @@ import daiquiri
 logger=daiquiri.getLogger('entropy.cache')
 from .utils import script_dir,make_dirs
 cache_path=os.path.join(script_dir(),'data','entropy_cache.db')
-logger.info(f'Opened database "{cache_path}"')
-make_dirs(cache_path)
-_cache=SqliteDict(cache_path,autocommit=False)
+_cache:SqliteDict=None
 
-def cache_get(key:Any,default:Any=None)->Any:
+def open_cache(path:str=None):
+    """Open (or switch to) the cache database. Called automatically with the default path on first use.
+        Processes that run at the same time should each use their own file, so they don't contend for SQLite's write lock.
+
+    Args:
+        path (str, optional): The database file. Defaults to None (data/entropy_cache.db next to the script).
+    """
+    global _cache,cache_path
+    if _cache is not None:
+        _cache.close()
+    cache_path=path or cache_path
+    make_dirs(cache_path)
+    _cache=SqliteDict(cache_path,autocommit=False)
+    logger.info(f'Opened database "{cache_path}"')
+
+def _get_cache()->SqliteDict:
+    if _cache is None:
+        open_cache()
+    return _cache
+
+def cache_key(key:Any,namespace:str=None)->Any:
+    """Get the key actually stored in the cache for a key in a namespace.
+        Used to keep the values of multiple accounts apart in the one cache.
+
+    Args:
+        key (Any): The key
+        namespace (str, optional): The namespace the key belongs to. Defaults to None (no namespace).
+
+    Returns:
+        Any: The namespaced key, or the key unchanged if no namespace is given
+    """
+    if namespace is None:
+        return key
+    return f'{namespace}:{key}'
+
+def cache_get(key:Any,default:Any=None,namespace:str=None)->Any:
     """Get a value from the cache. Works like dict.get()
 
     Args:
         key (Any): Key to access
         default (Any, optional): Value to return if key not found. Defaults to None.
+        namespace (str, optional): The namespace the key belongs to. Defaults to None.
 
     Returns:
         Any: The value, or None
     """
-    global _cache
+    _cache=_get_cache()
+    key=cache_key(key,namespace)
     if key in _cache:
         logger.debug(f'Cache hit for key "{key}"')
         return _cache[key]
     else: return default
 
-def cache_set(key:Any,val:Any,commit:bool=True,blocking_commit=False):
+def cache_set(key:Any,val:Any,commit:bool=True,blocking_commit=False,namespace:str=None):
     """Set a value in the cache.
 
     Args:
@@ -33,14 +68,16 @@ def cache_set(key:Any,val:Any,commit:bool=True,blocking_commit=False):
         val (Any): The value to set
         commit (bool, optional): Whether or not to commit the change to disk. Defaults to True.
         blocking_commit (bool, optional): Whether or not the commit is blocking or queued. Defaults to False.
+        namespace (str, optional): The namespace the key belongs to. Defaults to None.
     """
-    global _cache
+    _cache=_get_cache()
+    key=cache_key(key,namespace)
     _cache[key]=val
     if commit:
         _cache.commit(blocking_commit)
     logger.debug(f'Saved key "{key}" to cache')
 
-def cache_set_dict(d:dict,commit:bool=True,blocking_commit=False):
+def cache_set_dict(d:dict,commit:bool=True,blocking_commit=False,namespace:str=None):
     """Set keys/values in the cache to the keys/values in the dict.
         Functions the same as dict.update()
 
@@ -48,7 +85,11 @@ def cache_set_dict(d:dict,commit:bool=True,blocking_commit=False):
         d (dict): The dict to get keys/values from
         commit (bool, optional): [description]. Defaults to True.
         blocking_commit (bool, optional): [description]. Defaults to False.
+        namespace (str, optional): The namespace the keys belong to. Defaults to None.
     """
+    if namespace is not None:
+        d={cache_key(k,namespace):v for k,v in d.items()}
+    _cache=_get_cache()
     _cache.update(d)
     if commit:
         _cache.commit(blocking_commit)
@@ -1,11 +1,16 @@
 from .httpclient import HTTPClient, HTTPResponse
-from .gateway import Gateway,Gateway_Events
+from .gateway import Gateway,Gateway_Events,GatewayState
 from .cache import cache_get,cache_set
+from .entities import EntityStore
+from .messagestore import MessageStore
+from .search import SearchIndex
+from .members import MemberStore
+from .utils import ConnectLimiter
+from .snowflake import DISCORD_EPOCH
 import asyncio
 import aiohttp
 import daiquiri
 logger = daiquiri.getLogger('entropy.connection')
-DISCORD_EPOCH = 1420070400000
 API_VERSION=8
 
 class URLs():
@@ -32,15 +37,34 @@ class EntropyConnection():
     """
     user_agent = 'Entropy (https://github.com/wolfinabox/Entropy-API)'
 
-    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, http: HTTPClient = None, cache_namespace: str = None,
+                 connect_limiter: ConnectLimiter = None, entities: EntityStore = None, messages: MessageStore = None,
+                 search_index: SearchIndex = None, members: MemberStore = None, login_limiter: ConnectLimiter = None):
         """Initialize the connection object
 
         Args:
             loop (asyncio.AbstractEventLoop, optional): The async loop to use, otherwise one is created. Defaults to None.
+            http (HTTPClient, optional): An HTTP client to share with other connections, otherwise one is created. Defaults to None.
+            cache_namespace (str, optional): Namespace to store this connection's cache keys under. Defaults to None.
+            connect_limiter (ConnectLimiter, optional): Limiter to stagger gateway connections through. Defaults to None.
+            entities (EntityStore, optional): Store to share received guilds/users/channels through. Defaults to None.
+            messages (MessageStore, optional): Store to keep received messages in. Defaults to None.
+            search_index (SearchIndex, optional): Index to add received messages to. Defaults to None.
+            members (MemberStore, optional): Store to keep received guild members and presences in. Defaults to None.
+            login_limiter (ConnectLimiter, optional): Limiter (shared with other connections) to space out logins through. Defaults to None.
+        The stores are only used, not managed: whoever creates them starts and stops their background work
+        (eg: MessageStore.start_compaction(), SearchIndex.start_merging(), and their close()).
         """
         self.loop: asyncio.AbstractEventLoop = loop or asyncio.get_event_loop()
-        self.http = HTTPClient(self.loop)
-        self.gateway:Gateway=Gateway(self.loop)
+        self._owns_http = http is None
+        self.http = http or HTTPClient(self.loop)
+        self.cache_namespace = cache_namespace
+        self.gateway:Gateway=Gateway(self.loop,cache_namespace=cache_namespace,
+                                     connect_limiter=connect_limiter,entities=entities,messages=messages,
+                                     search_index=search_index,members=members)
+        self.messages = messages
+        self.search_index = search_index
+        self.login_limiter = login_limiter
         self.token: str = None
         self.id: int = None
 
@@ -57,6 +81,8 @@ class EntropyConnection():
             raise ValueError('Either login_info or token is required.')
 
         me = None
+        if self.login_limiter:
+            await self.login_limiter.wait()
         try:
             # logging in with email+password
             if login_info:
@@ -98,14 +124,18 @@ class EntropyConnection():
         # start gateway stuff
         gateway_url = gateway_path or (await self.http.request('GET', URLs.main_url, path=URLs.gateway_path))[0]['url']
         if not gateway_path:
-            cache_set('gateway_path',gateway_path)
+            cache_set('gateway_path',gateway_url,namespace=self.cache_namespace)
         await self.gateway.start(self.token,gateway_url)
         #TODO on ready??
 
     async def close(self):
         """Close the connection. Gracefully closes all open connections
+        A shared HTTP client is left open for its other users.
         """
-        await self.http.close()
+        if self.gateway.state!=GatewayState.DISCONNECTED:
+            await self.gateway.disconnect()
+        if self._owns_http:
+            await self.http.close()
 
     # PROBABLY A TEMP FUNCTION
     async def get_me(self, token):
@@ -0,0 +1,128 @@
+from typing import Any, Dict, List, Set, Tuple
+import daiquiri
+logger=daiquiri.getLogger('entropy.entities')
+
+class EntityStore(object):
+    """
+    A deduplicated store of Discord objects (guilds, users, channels...) shared between connections.\n
+    An object seen by several accounts is stored once, and updated in place as any of them receive it.
+    Fields that differ per account (eg: when the account joined a guild, or its own email) are kept
+    in a separate overlay per account instead of in the shared object.
+    """
+    #Fields that describe an object as seen by one account, rather than the object itself
+    private_fields={
+        'guild':frozenset(('joined_at','member','lazy','application_command_counts')),
+        'user':frozenset(('email','phone','mfa_enabled','verified','locale','nsfw_allowed','premium_type',
+                          'purchased_flags','premium_usage_flags','analytics_token','token')),
+        'channel':frozenset(('recipients','recipient_ids','last_message_id','last_pin_timestamp')),
+    }
+
+    def __init__(self):
+        self._entities:Dict[Tuple[str,str],dict]={}
+        self._owners:Dict[Tuple[str,str],Set[Any]]={}
+        self._overlays:Dict[Tuple[str,str],Dict[Any,dict]]={}
+
+    def __len__(self)->int:
+        return len(self._entities)
+
+    def add(self,kind:str,data:dict,owner:Any)->dict:
+        """Add an object to the store, or update the stored copy if it is already there.
+
+        Args:
+            kind (str): The kind of object (eg: "guild", "user")
+            data (dict): The object. Must contain an "id" key
+            owner (Any): The account the object is visible to (eg: its user id)
+
+        Returns:
+            dict: The stored (shared) copy of the object, without the owner's private fields
+        """
+        key=(kind,str(data['id']))
+        private=self.private_fields.get(kind,())
+        shared={k:v for k,v in data.items() if k not in private}
+        entity=self._entities.get(key)
+        if entity is None:
+            entity=self._entities[key]=shared
+        else:
+            entity.update(shared)
+        overlay={k:v for k,v in data.items() if k in private}
+        if overlay:
+            self._overlays.setdefault(key,{}).setdefault(owner,{}).update(overlay)
+        self._owners.setdefault(key,set()).add(owner)
+        return entity
+
+    def get(self,kind:str,id:Any,default:Any=None,owner:Any=None)->Any:
+        """Get an object from the store. Works like dict.get()
+
+        Args:
+            kind (str): The kind of object
+            id (Any): The id of the object
+            default (Any, optional): Value to return if the object isn't stored. Defaults to None.
+            owner (Any, optional): Get the object as seen by this account (with its private fields). Defaults to None (the shared object).
+
+        Returns:
+            Any: The object, or default
+        """
+        key=(kind,str(id))
+        entity=self._entities.get(key)
+        if entity is None:
+            return default
+        if owner is None:
+            return entity
+        if owner not in self._owners[key]:
+            return default
+        return {**entity,**self._overlays.get(key,{}).get(owner,{})}
+
+    def visible_to(self,kind:str,id:Any)->Set[Any]:
+        """Get the accounts an object is visible to.
+
+        Args:
+            kind (str): The kind of object
+            id (Any): The id of the object
+
+        Returns:
+            Set[Any]: The owners of the object
+        """
+        return set(self._owners.get((kind,str(id)),()))
+
+    def remove(self,kind:str,id:Any,owner:Any):
+        """Remove an object from an account (eg: it left the guild, or the channel was deleted).
+            The object is dropped once no account can see it.
+
+        Args:
+            kind (str): The kind of object
+            id (Any): The id of the object
+            owner (Any): The account that can no longer see the object
+        """
+        self._forget((kind,str(id)),owner)
+
+    def _forget(self,key:Tuple[str,str],owner:Any)->bool:
+        """
+        Remove an object from an owner, returning whether it was dropped from the store
+        """
+        owners=self._owners.get(key)
+        if owners is None:
+            return False
+        owners.discard(owner)
+        overlays=self._overlays.get(key)
+        if overlays is not None:
+            overlays.pop(owner,None)
+            if not overlays:
+                del self._overlays[key]
+        if not owners:
+            del self._owners[key]
+            del self._entities[key]
+            return True
+        return False
+
+    def release(self,owner:Any)->List[Tuple[str,str]]:
+        """Remove an account from the store. Objects no other account can see are dropped.
+
+        Args:
+            owner (Any): The account to remove
+
+        Returns:
+            List[Tuple[str,str]]: The (kind, id) of every object dropped
+        """
+        dropped=[key for key in list(self._owners) if self._forget(key,owner)]
+        logger.debug(f'Released entities of "{owner}", {len(self)} remaining')
+        return dropped
@@ -2,12 +2,17 @@ import os
 import json
 import asyncio
 import websockets
-from socket import gaierror
 import daiquiri
 import random
+import itertools
+from typing import List
 from datetime import datetime,timedelta
-from .utils import RepeatedTimer, get_os,fmt_time,make_dirs,script_dir
+from .utils import ConnectLimiter, get_os,fmt_time,make_dirs,script_dir
 from .cache import cache_get,cache_set, cache_set_dict
+from .entities import EntityStore
+from .messagestore import MessageStore
+from .search import SearchIndex
+from .members import MemberStore
 
 logger = daiquiri.getLogger('entropy.gateway')
 API_VERSION=8
@@ -24,6 +29,69 @@ class Gateway_Events(object):
         """
         logger.warn('No high-level handler for message_create defined')
 
+class MemberRequest(object):
+    """
+    A REQUEST GUILD MEMBERS (op 8) request, made with Gateway.request_guild_members().\n
+    Use `async for chunk in request` to get each GUILD_MEMBERS_CHUNK as it arrives,
+    or `await request` to get all the members at once. The request is sent when first iterated/awaited.
+    """
+    def __init__(self, gateway: 'Gateway', request_data: dict, timeout: float):
+        self.gateway = gateway
+        self.guild_id = request_data['guild_id']
+        self.nonce = request_data['nonce']
+        self.timeout = timeout
+        self.chunk_count: int = None
+        self.received = set()
+        self._request_data = request_data
+        self._sent = False
+        self._chunks = asyncio.Queue()
+
+    @property
+    def done(self) -> bool:
+        """Whether every chunk has been received
+        """
+        return self.chunk_count is not None and len(self.received) >= self.chunk_count
+
+    def _feed(self, chunk: dict):
+        self.chunk_count = chunk['chunk_count']
+        self.received.add(chunk['chunk_index'])
+        self._chunks.put_nowait(chunk)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if not self._sent:
+            self._sent = True
+            self.gateway._member_requests[self.nonce] = self
+            await self.gateway.send({'op': 8, 'd': self._request_data})
+        try:
+            while not (self.done and self._chunks.empty()):
+                # Raises asyncio.TimeoutError if Discord stops sending chunks (eg: the connection dropped)
+                yield await asyncio.wait_for(self._chunks.get(), self.timeout)
+        finally:
+            self.gateway._member_requests.pop(self.nonce, None)
+
+    def __await__(self):
+        return self._collect().__await__()
+
+    async def _collect(self) -> List[dict]:
+        members = []
+        async for chunk in self:
+            members.extend(chunk['members'])
+        return members
+
+class GatewayState():
+    """States of a gateway connection
+    """
+    DISCONNECTED = 'DISCONNECTED'  # Not started, or disconnected on purpose
+    CONNECTING = 'CONNECTING'  # Websocket open, waiting for HELLO
+    IDENTIFYING = 'IDENTIFYING'  # IDENTIFY sent, waiting for READY
+    RESUMING = 'RESUMING'  # RESUME sent, waiting for RESUMED
+    CONNECTED = 'CONNECTED'  # READY/RESUMED received, sends go straight out
+    RECONNECTING = 'RECONNECTING'  # Connection lost, backing off until a new one is opened
+    FAILED = 'FAILED'  # Closed with a fatal close code, won't reconnect
+
 class Gateway(object):
     """
     A WebSocket Gateway connection to Discord
@@ -80,38 +148,73 @@ class Gateway(object):
     intents['ALL']=sum(intents.values())
 
 
-    def __init__(self,loop:asyncio.AbstractEventLoop=None,sleep_resume:int=5,compression=None):
+    #What to do when the gateway is closed with each close code, see https://discord.com/developers/docs/topics/opcodes-and-status-codes#gateway-gateway-close-event-codes
+    #Connections dropped without a Discord close code (None, network errors, 1000-1015) are resumed too,
+    #any other unknown code gets a new session, in case the old one is what Discord rejected
+    resumable_close_codes=(4000,4001,4002,4005,4008)
+    reidentify_close_codes=(4003,4007,4009)
+    fatal_close_codes=(4004,4010,4011,4012,4013,4014)
+
+    def __init__(self,loop:asyncio.AbstractEventLoop=None,backoff_base:float=1.0,backoff_max:float=60.0,compression=None,
+                 cache_namespace:str=None,connect_limiter:ConnectLimiter=None,entities:EntityStore=None,messages:MessageStore=None,
+                 search_index:SearchIndex=None,members:MemberStore=None):
         """A gateway connection to the Discord API. The gateway handles all live events.
 
         Args:
             loop (asyncio.AbstractEventLoop, optional): The async loop to use, otherwise one is created. Defaults to None.
-            sleep_resume (int, optional): Amount of time in seconds to sleep between attempts to resume a broken connection. Defaults to 5.
+            backoff_base (float, optional): Base amount of time in seconds to back off between attempts to reconnect, doubled every failed attempt. Defaults to 1.0.
+            backoff_max (float, optional): Maximum amount of time in seconds to back off between attempts to reconnect. Defaults to 60.0.
             compression ([type], optional): #TODO remember what this is. Defaults to None.
+            cache_namespace (str, optional): Namespace to store this gateway's cache keys under. Defaults to None.
+            connect_limiter (ConnectLimiter, optional): Limiter (shared with other gateways) to stagger connection attempts through. Defaults to None.
+            entities (EntityStore, optional): Store (shared with other gateways) to put received guilds/users/channels in. Defaults to None.
+            messages (MessageStore, optional): Store to keep received messages (and their edits/deletes) in. Defaults to None.
+            search_index (SearchIndex, optional): Index to add received messages (and their edits/deletes) to. Defaults to None.
+            members (MemberStore, optional): Store to keep received guild members (and their updates/presences) in. Defaults to None.
         """
         self.gateway_events=Gateway_Events()
         self.token:str=None
-        self.sleep_resume=sleep_resume
+        self.backoff_base=backoff_base
+        self.backoff_max=backoff_max
         self.encoding='json'
         self.gateway_url=None
         self.loop: asyncio.AbstractEventLoop = loop or asyncio.get_event_loop()
         self.compression=compression
-        self.closed=True
-        self.identified=False
+        self.state:str=GatewayState.DISCONNECTED
         self.session_id=None
         self._websocket: websockets.WebSocketClientProtocol=None
         self.gateway_task:asyncio.Task=None
+        self._reconnect_task:asyncio.Task=None
+        self._reconnect_attempts=0
         self.gateway_intents=self.intents['ALL']#-self.intents['GUILD_PRESENCES']-self.intents['GUILD_MEMBERS']
+        self.cache_namespace=cache_namespace
+        self.connect_limiter=connect_limiter
+        self.entities=entities
+        self.messages=messages
+        self.search_index=search_index
+        self.members=members
+        self._member_requests={}
+        self._nonces=itertools.count()
+        self.user_id:str=None
 
         #Heartbeat
         self.last_sequence:int=None
         self.heartbeat_ms:int = None
-        self.heartbeat_repeater: RepeatedTimer = None
-        self.last_heartbeat_ack:int = None
-        self.last_heartbeat_sent:int = None
+        self.heartbeat_task: asyncio.Task = None
+        self.last_heartbeat_ack:datetime = None
+        self.last_heartbeat_sent:datetime = None
+        self.latency:timedelta = None
+        self._heartbeat_acked=True
 
         # Structure
         self.send_queue = []
 
+    @property
+    def closed(self)->bool:
+        """Whether the gateway is stopped (never started, disconnected, or failed). A reconnecting gateway is not closed.
+        """
+        return self.state in (GatewayState.DISCONNECTED,GatewayState.FAILED)
+
     async def start(self,token:str,gateway_url:str):
         """Start the gateway
 
@@ -124,117 +227,257 @@ class Gateway(object):
             return
         self.token=token
         self.gateway_url=gateway_url+f'/?v={API_VERSION}&encoding={self.encoding}'
+        self.session_id=None
+        self.last_sequence=None
         logger.debug('Starting gateway...')
-        self._websocket = await websockets.connect(self.gateway_url, compression=self.compression)
+        self._set_state(GatewayState.CONNECTING)
+        try:
+            self._websocket = await self._connect()
+        except Exception:
+            self._set_state(GatewayState.DISCONNECTED)
+            raise
         #start the main loop
-        self.gateway_task=asyncio.create_task(self._runloop(),name='entropy-gateway-loop')
+        self.gateway_task=asyncio.create_task(self._runloop(self._websocket),name='entropy-gateway-loop')
+
+    def _set_state(self,state:str):
+        """
+        Move the gateway to a new state
+        """
+        if state!=self.state:
+            logger.debug(f'Gateway state {self.state} -> {state}')
+            self.state=state
 
+    async def _connect(self)->websockets.WebSocketClientProtocol:
+        """
+        Open a new websocket to the gateway, waiting on the connect limiter first if there is one
+        """
+        if self.connect_limiter:
+            await self.connect_limiter.wait()
+        return await websockets.connect(self.gateway_url, compression=self.compression, close_timeout=2)
 
-    async def _runloop(self):
-        self.closed=False
+    async def _runloop(self,websocket:websockets.WebSocketClientProtocol):
         logger.info(f'Gateway successfully opened to  {self.gateway_url}')
-        while not self._websocket.closed and not self.closed:
+        while True:
             try:
-                res=await self._websocket.recv()
-                await self._handle_message(json.loads(res))
-
+                res=await websocket.recv()
             except (websockets.ConnectionClosed,OSError) as e:
-                await self._handle_close_event(e)
+                #Only the loop of the current websocket gets to react to it closing
+                if websocket is self._websocket:
+                    await self._handle_close_event(e)
+                return
+            #A failing handler (eg: a full disk) is not a dropped connection, so log it and keep receiving
+            try:
+                await self._handle_message(json.loads(res))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('Error handling gateway message',error=e)
 
     async def send(self, data: dict):
         """Send date over the gateway.
+        If the gateway isn't connected, the data is queued and sent once the session is READY/RESUMED.
 
         Args:
             data (dict): The data to send. Must contain at least {op,d}, and must be serializable as JSON
         """
-        # If gateway not open
-        if self.closed or not self._websocket or self._websocket.closed:
+        if self.state!=GatewayState.CONNECTED or not await self._send_now(data):
             logger.warn(f'Send Queued: {data}')
             self.send_queue.append(data)
-            return
-        # Convert data to json string
-        data_string = data if type(data) == str else json.dumps(data)
-        # Send
+
+    async def _send_now(self, data: dict)->bool:
+        """
+        Send data over the current websocket right away, whatever state the gateway is in.\n
+        `data` The data to send\n
+        returns : True if the data was sent, False if the websocket is closed (it will be reconnected by its loop)
+        """
+        if not self._websocket:
+            return False
         try:
-            await self._websocket.send(data_string)
-
-        except (websockets.ConnectionClosed,OSError) as e:
-            #If the message could not be sent, queue it to be sent later
-            logger.warn(f'Send Queued: {data_string}')
-            self.send_queue.append(data_string)
-            #If gateway wasn't already closed, close it
-            await self._handle_close_event()
+            await self._websocket.send(json.dumps(data))
+        except (websockets.ConnectionClosed,OSError):
+            return False
         logger.debug(
             f'SENT: op[{data["op"]}] ({self.opcodes[data["op"]]})')
+        return True
+
+    def request_guild_members(self, guild_id: str, query: str = '', limit: int = 0, presences: bool = False,
+                              user_ids: List[str] = None, timeout: float = 30.0) -> MemberRequest:
+        """Request the members of a guild (op 8). The members are also added to the member store, if there is one.
+
+        Args:
+            guild_id (str): The guild
+            query (str, optional): Only get members whose username starts with this. Defaults to '' (all members).
+            limit (int, optional): The maximum number of members to get. Defaults to 0 (no limit).
+            presences (bool, optional): Whether to get the presences of the members too. Defaults to False.
+            user_ids (List[str], optional): Get these members, instead of using query. Defaults to None.
+            timeout (float, optional): The time in seconds to wait for each chunk before giving up. Defaults to 30.0.
+
+        Returns:
+            MemberRequest: The request, to iterate over (chunk by chunk) or await (all members)
+        """
+        nonce = f'{next(self._nonces)}'
+        request_data = {'guild_id': guild_id, 'limit': limit, 'presences': presences, 'nonce': nonce}
+        if user_ids is not None:
+            request_data['user_ids'] = user_ids
+        else:
+            request_data['query'] = query
+        return MemberRequest(self, request_data, timeout)
+
+    async def _flush_send_queue(self):
+        """
+        Send all queued data, in order. Stops (keeping the rest queued) if the connection drops again.
+        """
+        queue,self.send_queue=self.send_queue,[]
+        for i,data in enumerate(queue):
+            if not await self._send_now(data):
+                self.send_queue=queue[i:]+self.send_queue
+                return
 
     async def disconnect(self, code: int = 1000, reason: str = ''):
         """
-        Disconnect the gateway.\n
+        Disconnect the gateway. The gateway won't try to reconnect.\n
+        `code` The close code to send. Default 1000 (which ends the session).\n
         `reason` The reason to send for the disconnection. Default empty.
         """
-        # logger.error('got deaded',code=self._websocket.close_code,reason=self._websocket.close_reason)
-        self.closed = True
-        if self.heartbeat_repeater:
-            self.heartbeat_repeater.stop()
-        # self.gateway_task.cancel()
-        if not self._websocket.closed:
-            await self._websocket.close(code=int(code), reason=reason)
+        self._set_state(GatewayState.DISCONNECTED)
+        if self._reconnect_task and self._reconnect_task is not asyncio.current_task():
+            self._reconnect_task.cancel()
+        await self._stop_tasks()
+        await self._close_websocket(code,reason)
         logger.warn('Gateway disconnected',code=code,reason=reason)
 
+    async def _stop_tasks(self):
+        """
+        Cancel the heartbeat and receive loop tasks, and wait for them to finish
+        """
+        current=asyncio.current_task()
+        for task in (self.heartbeat_task,self.gateway_task):
+            if task and task is not current and not task.done():
+                task.cancel()
+                await asyncio.gather(task,return_exceptions=True)
+
+    async def _close_websocket(self, code: int, reason: str = ''):
+        """
+        Close the current websocket, if it is open
+        """
+        if self._websocket and not self._websocket.closed:
+            try:
+                await self._websocket.close(code=int(code), reason=reason)
+            except OSError:
+                pass
+
+    @classmethod
+    def classify_close(cls, code: int)->str:
+        """
+        Classify a gateway close code.\n
+        `code` The close code (None if the connection dropped without one)\n
+        returns : "resume" if the session can be resumed, "identify" if a new session is needed, or "fatal" if reconnecting won't help
+        """
+        if code in cls.fatal_close_codes:
+            return 'fatal'
+        if code in cls.reidentify_close_codes:
+            return 'identify'
+        if code is None or code in cls.resumable_close_codes or code<4000:
+            return 'resume'
+        logger.warn(f'Unknown gateway close code {code}, starting a new session')
+        return 'identify'
+
+    def _backoff(self)->float:
+        """
+        Get the time in seconds to wait before the next reconnect attempt.\n
+        Exponential backoff, with (equal) jitter so many gateways dropped at once don't reconnect in lockstep.
+        """
+        if not self._reconnect_attempts:
+            return 0.0
+        cap=min(self.backoff_max,self.backoff_base*2**(self._reconnect_attempts-1))
+        return random.uniform(cap/2,cap)
+
+    def _schedule_reconnect(self, identify: bool = False):
+        """
+        Start reconnecting, unless a reconnect is already in progress (there is only ever one).\n
+        `identify` Whether the session is gone, and a new IDENTIFY is needed instead of a RESUME
+        """
+        if identify:
+            self.session_id=None
+            self.last_sequence=None
+        if self.closed:
+            return
+        if self._reconnect_task and not self._reconnect_task.done():
+            return
+        self._set_state(GatewayState.RECONNECTING)
+        self._reconnect_task=asyncio.create_task(self._reconnect(),name='entropy-gateway-reconnect')
+
+    async def _reconnect(self):
+        """
+        Tear down the current connection, and open a new one (backing off between failed attempts).\n
+        The new connection resumes or identifies once it receives HELLO.
+        """
+        await self._stop_tasks()
+        # 4000 rather than 1000, so that the session stays resumable
+        await self._close_websocket(4000)
+        while True:
+            delay=self._backoff()
+            self._reconnect_attempts+=1
+            if delay:
+                logger.debug(f'Reconnecting in {delay:.2f}s (attempt {self._reconnect_attempts})...')
+                await asyncio.sleep(delay)
+            logger.debug('Trying to reconnect gateway...')
+            try:
+                websocket = await self._connect()
+                break
+            except (OSError,asyncio.TimeoutError,websockets.WebSocketException) as e:
+                logger.warn(
+                    f'Could not reconnect to "{self.gateway_url}"!',error=e)
+        logger.debug('Reconnected to gateway')
+        self._websocket=websocket
+        self._set_state(GatewayState.CONNECTING)
+        self.gateway_task=asyncio.create_task(self._runloop(websocket),name='entropy-gateway-loop')
+
     async def _resume(self):
         """
-        Attempt to resume the gateway connection
+        Send a resume packet to Discord, to pick the session back up after reconnecting
         """
-        reconnect_packet = {
+        self._set_state(GatewayState.RESUMING)
+        await self._send_now({
             'op': 6,
             'd': {
                 'token': self.token,
                 'session_id': self.session_id,
                 'seq': self.last_sequence
             }
-        }
-        # Close codes said to require another identify
-        if self._websocket.close_code in (4007, 4009):
-            self.identified = False
-        while self._websocket.closed:
-            logger.debug('Trying to resume gateway...')
-            try:
-                self._websocket = await websockets.connect(self.gateway_url, compression=self.compression)
-            except gaierror as e:
-                logger.warn(
-                    f'Could not reconncet to "{self.gateway_url}"!',error=e)
-                logger.debug(f'Trying again in {self.sleep_resume}s...')
-                await asyncio.sleep(self.sleep_resume)
-        # Reconnected!
-        logger.debug('Reconnected to gateway')
-        self.closed=False
-        await self.send(reconnect_packet)
-        asyncio.create_task(self._runloop(),name='entropy-gateway-loop')
-        # Send all queued messages
-        while self.send_queue:
-            await self.send(self.send_queue.pop(0))
+        })
 
     #Specific message templates
     async def _heartbeat(self, onetime=False):
         """
         Send heartbeat message
         """
-        if not onetime and self.last_heartbeat_ack is None:
+        if not onetime and not self._heartbeat_acked:
+            # Zombied connection, the websocket won't notice by itself
             logger.error('No heartbeat ACK received!')
-            asyncio.ensure_future(self.disconnect('123'))
-            asyncio.ensure_future(self._resume())
+            self._schedule_reconnect()
             return
+        self._heartbeat_acked = False
         self.last_heartbeat_sent = datetime.now()
-        await self.send({
+        await self._send_now({
             'op': 1,
             'd': self.last_sequence
         })
 
+    async def _heartbeat_loop(self):
+        """
+        Send a heartbeat every heartbeat interval, until the connection is torn down
+        """
+        while True:
+            await asyncio.sleep(float(self.heartbeat_ms)/1000.00)
+            await self._heartbeat()
+
     async def _identify(self):
         """
         Send an identify packet to Discord
         """
-        await self.send({
+        self._set_state(GatewayState.IDENTIFYING)
+        await self._send_now({
             'op': 2,
             'd': {
                 'token': self.token,
@@ -246,23 +489,27 @@ class Gateway(object):
                     }
             }
         })
-        self.identified = True
 
     #Handlers
-    async def _handle_close_event(self,error:websockets.ConnectionClosed):
+    async def _handle_close_event(self,error:Exception):
         """Handle a gateway close event
 
         Args:
-            error (websockets.ConnectionClosed): The close event "error"
+            error (Exception): The close event "error" (websockets.ConnectionClosed, or an OSError for network errors)
         """
-        if not self.closed:
-            if type(error)==websockets.ConnectionClosed:
-                logger.error(f'Gateway closed',code=error.code,reason=error.reason)
-            else:
-                logger.error(f'Gateway connection error',error=error)
-
-            await self.disconnect()
-        await self._resume()
+        code=None
+        if isinstance(error,websockets.ConnectionClosed):
+            code=error.code
+            logger.error(f'Gateway closed',code=code,reason=self.close_codes.get(code,error.reason))
+        else:
+            logger.error(f'Gateway connection error',error=error)
+        action=self.classify_close(code)
+        if action=='fatal':
+            logger.error(f'Gateway cannot reconnect after close code {code}')
+            self._set_state(GatewayState.FAILED)
+            await self._stop_tasks()
+            return
+        self._schedule_reconnect(identify=action=='identify')
 
     async def _handle_message(self, data: dict):
         """
@@ -281,38 +528,39 @@ class Gateway(object):
             await self._heartbeat(onetime=True)
 
         async def op7():  # Reconnect Request
-            logger.error(f'Gateway closed! (API requested reconnect)')
-            await self.disconnect()
-            self.identified = False
-            await self._resume()
+            logger.warn(f'API requested reconnect')
+            self._schedule_reconnect()
 
         async def op9():  # Invalid Session
+            # Discord asks for a random 1-5s wait before trying again
+            await asyncio.sleep(random.uniform(1, 5))
             #If session is resumable
-            if data['d']:
-                # temp
-                await asyncio.sleep(random.randint(1, 5))
-                await self._identify()
+            if data['d'] and self.session_id:
+                await self._resume()
             else:
-                logger.error('Cannot resume from INVALID SESSION!')
-                # TEMPORARY (obviously)
-                # await self.disconnect(1001)
-                raise ConnectionError('Cannot resume from INVALID SESSION')
-            ...
+                logger.warn('Session invalidated, identifying again')
+                self.session_id = None
+                self.last_sequence = None
+                await self._identify()
 
         async def op10():  # Hello
             self.heartbeat_ms = data['d']['heartbeat_interval']
             logger.debug(f'Heartbeating every {self.heartbeat_ms/1000}s!')
-            # Set up heatbeat repeater
+            # Set up heatbeat task
+            self._heartbeat_acked = True
             await self._heartbeat(onetime=True)
-            self.heartbeat_repeater = RepeatedTimer(
-                float(self.heartbeat_ms)/1000.00, self._heartbeat, self, _loop=self.loop)
-            self.heartbeat_repeater.start()
-            if not self.identified:
+            if self.heartbeat_task:
+                self.heartbeat_task.cancel()
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop(),name='entropy-gateway-heartbeat')
+            if self.session_id:
+                await self._resume()
+            else:
                 logger.debug(f'Gateway intents: {self.gateway_intents}')
                 await self._identify()
 
         async def op11():  # Heartbeat ACK
             self.last_heartbeat_ack = datetime.now()
+            self._heartbeat_acked = True
             self.latency = (self.last_heartbeat_ack-self.last_heartbeat_sent)
             logger.debug(f'Latency: {fmt_time(self.latency)}')
 
@@ -323,13 +571,36 @@ class Gateway(object):
         handlers = {
             0: op0,
             1: op1,
+            7: op7,
             9: op9,
             10: op10,
             11: op11
         }
-        self.last_sequence = data['s']
+        if data['s'] is not None:
+            self.last_sequence = data['s']
         await handlers.get(data['op'], op_unhandled)()
 
+    async def _session_established(self):
+        """
+        Called on READY/RESUMED. The gateway is fully connected, so send everything queued while it wasn't
+        """
+        self._set_state(GatewayState.CONNECTED)
+        self._reconnect_attempts = 0
+        await self._flush_send_queue()
+
+    def _store_guild(self, guild: dict):
+        """
+        Put a guild in the entity store. Its channels are stored as channel entities of their own
+        (so CHANNEL_* events keep them current), and the guild keeps only their ids
+        """
+        channels=guild.get('channels')
+        if channels is not None:
+            guild={**guild,'channel_ids':[channel['id'] for channel in channels]}
+            del guild['channels']
+            for channel in channels:
+                self.entities.add('channel',{**channel,'guild_id':guild['id']},self.user_id)
+        self.entities.add('guild',guild,self.user_id)
+
     async def _handle_event(self, data: dict):
         """
         Handle an event message sent from the Discord API\n
@@ -341,14 +612,101 @@ class Gateway(object):
         # EVENTS
         async def ready_t():  # Ready
             self.session_id = data['d']['session_id']
-            cache_set_dict(data['d'])
+            self.user_id = data['d']['user']['id']
+            #Only this account's own keys, the guilds/users/channels it shares with other accounts go in the entity store
+            cache_set_dict({'session_id':self.session_id,'user':data['d']['user']},namespace=self.cache_namespace)
+            if self.entities is not None:
+                self.entities.add('user',data['d']['user'],self.user_id)
+                for user in data['d'].get('users',()):
+                    self.entities.add('user',user,self.user_id)
+                for channel in data['d'].get('private_channels',()):
+                    self.entities.add('channel',channel,self.user_id)
+                for guild in data['d'].get('guilds',()):
+                    self._store_guild(guild)
+            await self._session_established()
 
         async def resume_t():  # Resume confirmation
             logger.debug('Successfully resumed')
+            await self._session_established()
 
         async def message_create_t():  # Message_Create
+            if self.messages is not None:
+                self.messages.add(data['d'])
+            if self.search_index is not None:
+                self.search_index.add(data['d'])
             await self.gateway_events.message_create(data['d'])
 
+        async def message_update_t():  # Message_Update
+            if self.messages is not None:
+                self.messages.update(data['d'])
+            if self.search_index is not None:
+                self.search_index.update(data['d'])
+
+        async def message_delete_t():  # Message_Delete
+            if self.messages is not None:
+                self.messages.delete(data['d']['channel_id'],data['d']['id'])
+            if self.search_index is not None:
+                self.search_index.delete(data['d']['id'])
+
+        async def message_delete_bulk_t():  # Message_Delete_Bulk
+            if self.messages is not None:
+                for message_id in data['d']['ids']:
+                    self.messages.delete(data['d']['channel_id'],message_id)
+            if self.search_index is not None:
+                for message_id in data['d']['ids']:
+                    self.search_index.delete(message_id)
+
+        async def guild_members_chunk_t():  # Guild_Members_Chunk
+            if self.members is not None:
+                self.members.add_members(data['d']['guild_id'],data['d']['members'],data['d'].get('presences'))
+            request = self._member_requests.get(data['d'].get('nonce'))
+            if request is not None:
+                request._feed(data['d'])
+
+        async def guild_member_update_t():  # Guild_Member_Add/Guild_Member_Update
+            if self.members is not None:
+                self.members.update_member(data['d']['guild_id'],data['d'])
+
+        async def guild_member_remove_t():  # Guild_Member_Remove
+            if self.members is not None:
+                self.members.remove_member(data['d']['guild_id'],data['d']['user']['id'])
+
+        async def presence_update_t():  # Presence_Update
+            if self.members is not None and 'guild_id' in data['d']:
+                self.members.update_presence(data['d'])
+
+        async def guild_update_t():  # Guild_Create/Guild_Update
+            if self.entities is not None:
+                self._store_guild(data['d'])
+
+        async def guild_delete_t():  # Guild_Delete
+            guild_id=data['d']['id']
+            if data['d'].get('unavailable'):
+                # Outage, the guild is still there
+                if self.entities is not None:
+                    self.entities.add('guild',data['d'],self.user_id)
+                return
+            if self.entities is not None:
+                guild=self.entities.get('guild',guild_id)
+                for channel_id in (guild or {}).get('channel_ids',()):
+                    self.entities.remove('channel',channel_id,self.user_id)
+                self.entities.remove('guild',guild_id,self.user_id)
+            #A shared member store keeps the guild's members while another account is still in it
+            if self.members is not None and (self.entities is None or not self.entities.visible_to('guild',guild_id)):
+                self.members.remove_guild(guild_id)
+
+        async def channel_update_t():  # Channel_Create/Channel_Update
+            if self.entities is not None:
+                self.entities.add('channel',data['d'],self.user_id)
+
+        async def channel_delete_t():  # Channel_Delete
+            if self.entities is not None:
+                self.entities.remove('channel',data['d']['id'],self.user_id)
+
+        async def user_update_t():  # User_Update (the logged in user)
+            if self.entities is not None:
+                self.entities.add('user',data['d'],self.user_id)
+
         async def unknown_t():  # Unknown event
             logger.warn(f'Unhandled event "{data["t"]}"!')
             # if 'DEBUG' not in os.environ or not os.environ['DEBUG']:return
@@ -362,6 +720,21 @@ class Gateway(object):
             'READY': ready_t,
             'RESUMED': resume_t,
             'MESSAGE_CREATE': message_create_t,
+            'MESSAGE_UPDATE': message_update_t,
+            'MESSAGE_DELETE': message_delete_t,
+            'MESSAGE_DELETE_BULK': message_delete_bulk_t,
+            'GUILD_MEMBERS_CHUNK': guild_members_chunk_t,
+            'GUILD_MEMBER_ADD': guild_member_update_t,
+            'GUILD_MEMBER_UPDATE': guild_member_update_t,
+            'GUILD_MEMBER_REMOVE': guild_member_remove_t,
+            'PRESENCE_UPDATE': presence_update_t,
+            'GUILD_CREATE': guild_update_t,
+            'GUILD_UPDATE': guild_update_t,
+            'GUILD_DELETE': guild_delete_t,
+            'CHANNEL_CREATE': channel_update_t,
+            'CHANNEL_UPDATE': channel_update_t,
+            'CHANNEL_DELETE': channel_delete_t,
+            'USER_UPDATE': user_update_t,
             # 'SESSIONS_REPLACE': sess_repl_t,
         }
         await handlers.get(data['t'], unknown_t)()
\ No newline at end of file
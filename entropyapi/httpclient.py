@@ -81,16 +81,37 @@ class HTTPClient:
     """HTTP client used to make requests to the Discord API (or other endpoints).
     """
 
-    def __init__(self,loop:asyncio.AbstractEventLoop=None,connection_timeout:int=5):
+    def __init__(self,loop:asyncio.AbstractEventLoop=None,connection_timeout:int=5,pool_size:int=100,rate_limit_retries:int=3):
         """Create an HTTP client
 
         Args:
             loop (asyncio.AbstractEventLoop, optional): The async loop to use, otherwise one is created. Defaults to None.
             connection_timeout (int, optional): The amount of time in seconds to wait before timing out a connection. Defaults to 5.
+            pool_size (int, optional): The maximum number of simultaneous connections in the pool. Defaults to 100.
+            rate_limit_retries (int, optional): The number of times to retry a request rate limited (429) by Discord, after waiting as asked. Defaults to 3.
         """
         self.loop:asyncio.AbstractEventLoop=loop or asyncio.get_event_loop()
         self.connection_timeout=connection_timeout
-        self._session=aiohttp.ClientSession(loop=self.loop)
+        self.pool_size=pool_size
+        self.rate_limit_retries=rate_limit_retries
+        self._session=self._create_session()
+
+    def _create_session(self)->aiohttp.ClientSession:
+        """Create the aiohttp session (and its connection pool) used for requests.
+        """
+        connector=aiohttp.TCPConnector(limit=self.pool_size,loop=self.loop)
+        return aiohttp.ClientSession(connector=connector,loop=self.loop)
+
+    @staticmethod
+    async def _retry_after(response:aiohttp.ClientResponse)->float:
+        """Get the time in seconds Discord asked to wait before retrying a rate limited (429) response.
+        """
+        try:
+            return float((await response.json())['retry_after'])
+        except (ValueError,KeyError,TypeError,aiohttp.ContentTypeError):
+            return float(response.headers.get('Retry-After',1))
+        finally:
+            response.release()
 
     async def close(self):
         """Close the HTTP client.
@@ -118,7 +139,7 @@ class HTTPClient:
         if method.upper() not in ('POST','GET','PUT','DELETE','HEAD','OPTIONS','PATCH'):
             raise ValueError(f"Invalid HTTP request type {method.upper()}, Must be one of {', '.join(('POST','GET','PUT','DELETE','HEAD','OPTIONS','PATCH'))}")
         if not self._session or self._session.closed:
-            self._session=aiohttp.ClientSession(loop=self.loop)
+            self._session=self._create_session()
 
 
         #Construct headers and format data
@@ -129,15 +150,21 @@ class HTTPClient:
         if 'Content-Length' not in headers:
             headers['Content-Length']=str(len(data)) if data else '0'
 
-        #Make request
+        #Make request, waiting out and retrying rate limits
         response:aiohttp.ClientResponse=None
         timeout=aiohttp.ClientTimeout(total=self.connection_timeout)
-        try:
-            response=await self._session.request((method.upper()),url+path,timeout=timeout,data=data,headers=headers,**kwargs)
-        except aiohttp.ServerTimeoutError as e:
-            raise
-        except aiohttp.ClientOSError as e:
-            raise
+        for attempt in range(self.rate_limit_retries+1):
+            try:
+                response=await self._session.request((method.upper()),url+path,timeout=timeout,data=data,headers=headers,**kwargs)
+            except aiohttp.ServerTimeoutError as e:
+                raise
+            except aiohttp.ClientOSError as e:
+                raise
+            if response.status!=429 or attempt==self.rate_limit_retries:
+                break
+            retry_after=await self._retry_after(response)
+            logger.warn(f'{method.upper()} request to {url+path} rate limited, retrying in {retry_after:.2f}s')
+            await asyncio.sleep(retry_after)
         if return_json:
             result=await response.json(encoding=encoding)
         else:
@@ -0,0 +1,143 @@
+import os
+import asyncio
+import multiprocessing
+from typing import Callable, Dict
+import daiquiri
+from .connection import EntropyConnection, URLs
+from .httpclient import HTTPClient
+from .entities import EntityStore
+from .members import MemberStore
+from .cache import open_cache
+from .utils import ConnectLimiter, script_dir
+logger = daiquiri.getLogger('entropy.manager')
+
+
+class EntropyManager():
+    """Hosts many EntropyConnections (accounts) in one loop.
+    All connections share one HTTP session/connection pool, one entity store and one member store,
+    keep their cache keys in their own namespace, and have their logins and gateway (re)connects staggered.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, stagger: float = 1.0, pool_size: int = 100,
+                 login_interval: float = 0.5):
+        """Initialize the manager
+
+        Args:
+            loop (asyncio.AbstractEventLoop, optional): The async loop to use, otherwise one is created. Defaults to None.
+            stagger (float, optional): Minimum time in seconds between two gateway (re)connects. Defaults to 1.0.
+            pool_size (int, optional): The maximum number of simultaneous HTTP connections shared by all accounts. Defaults to 100.
+            login_interval (float, optional): Minimum time in seconds between two account logins, to stay clear of rate limits. Defaults to 0.5.
+        """
+        self.loop: asyncio.AbstractEventLoop = loop or asyncio.get_event_loop()
+        self.http = HTTPClient(self.loop, pool_size=pool_size)
+        self.connect_limiter = ConnectLimiter(stagger)
+        self.login_limiter = ConnectLimiter(login_interval)
+        self.entities = EntityStore()
+        self.members = MemberStore(self.entities)
+        self.connections: Dict[str, EntropyConnection] = {}
+        self._closed = asyncio.Event()
+
+    def add_connection(self, name: str) -> EntropyConnection:
+        """Create a connection hosted by this manager
+
+        Args:
+            name (str): A unique name for the account, used as its cache namespace
+
+        Returns:
+            EntropyConnection: The (not yet started) connection
+        """
+        if name in self.connections:
+            raise ValueError(f'A connection named "{name}" already exists')
+        connection = EntropyConnection(self.loop, http=self.http, cache_namespace=name,
+                                       connect_limiter=self.connect_limiter, entities=self.entities,
+                                       members=self.members, login_limiter=self.login_limiter)
+        self.connections[name] = connection
+        return connection
+
+    async def start_all(self, accounts: Dict[str, dict]):
+        """Create and start a connection for each account
+
+        Args:
+            accounts (Dict[str, dict]): Account names mapped to the kwargs for EntropyConnection.start() (login_info or token)
+        Accounts that fail to log in are logged and removed, the rest are left running.
+        """
+        # Every account connects to the same gateway, so only ask for it once
+        gateway_url = (await self.http.request('GET', URLs.main_url, path=URLs.gateway_path))[0]['url']
+        names = list(accounts)
+        results = await asyncio.gather(
+            *(self.add_connection(name).start(**{'gateway_path': gateway_url, **accounts[name]}) for name in names),
+            return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error(f'Couldn\'t start connection "{name}"', error=result)
+                await self.remove_connection(name)
+
+    async def remove_connection(self, name: str):
+        """Close and remove a connection
+
+        Args:
+            name (str): The name of the connection
+        """
+        connection = self.connections.pop(name)
+        await connection.close()
+        if connection.gateway.user_id is not None:
+            for kind, id in self.entities.release(connection.gateway.user_id):
+                if kind == 'guild':
+                    # No remaining account is in the guild
+                    self.members.remove_guild(id)
+
+    async def close(self):
+        """Close all connections, then the shared HTTP session
+        """
+        for name in list(self.connections):
+            await self.remove_connection(name)
+        await self.http.close()
+        self._closed.set()
+
+    async def wait_closed(self):
+        """Wait until the manager is closed
+        """
+        await self._closed.wait()
+
+    @staticmethod
+    def run_sharded(accounts: Dict[str, dict], processes: int = None, setup: Callable[['EntropyManager'], None] = None, **kwargs):
+        """Split accounts between worker processes, each running its own loop and EntropyManager. Blocks until all workers exit.
+            Workers are spawned (not forked), and each uses its own cache file (data/entropy_cache_<shard>.db) so they don't contend
+            for the database; call this from under `if __name__ == '__main__':`.
+
+        Args:
+            accounts (Dict[str, dict]): Account names mapped to the kwargs for EntropyConnection.start()
+            processes (int, optional): The number of worker processes. Defaults to None (one per CPU core).
+            setup (Callable[[EntropyManager], None], optional): Picklable function called with each worker's manager before it starts, eg: to attach event handlers. Defaults to None.
+            All other **kwargs are passed to EntropyManager()
+        """
+        names = sorted(accounts)
+        processes = max(1, min(processes or os.cpu_count() or 1, len(names)))
+        # Forked workers would inherit the cache's SqliteDict without its writer thread
+        context = multiprocessing.get_context('spawn')
+        workers = []
+        for i in range(processes):
+            shard = {name: accounts[name] for name in names[i::processes]}
+            worker = context.Process(target=_run_shard, args=(i, shard, setup, kwargs), name=f'entropy-shard-{i}')
+            worker.start()
+            workers.append(worker)
+        logger.info(f'Started {len(names)} accounts across {processes} processes')
+        for worker in workers:
+            worker.join()
+
+
+def _run_shard(shard: int, accounts: Dict[str, dict], setup: Callable[[EntropyManager], None], kwargs: dict):
+    """Entry point of a worker process started by EntropyManager.run_sharded()
+    """
+    open_cache(os.path.join(script_dir(), 'data', f'entropy_cache_{shard}.db'))
+
+    async def main():
+        manager = EntropyManager(**kwargs)
+        if setup:
+            setup(manager)
+        try:
+            await manager.start_all(accounts)
+            await manager.wait_closed()
+        finally:
+            await manager.close()
+    asyncio.run(main())
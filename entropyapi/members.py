@@ -0,0 +1,296 @@
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional
+import daiquiri
+logger = daiquiri.getLogger('entropy.members')
+from .snowflake import Snowflake
+from .entities import EntityStore
+
+#Presence statuses, stored as one byte per member
+statuses = ('offline', 'online', 'idle', 'dnd')
+_status_codes = {status: code for code, status in enumerate(statuses)}
+_no_roles = array('Q')
+
+
+class _GuildMembers(object):
+    """
+    The members of one guild, stored column-wise (one row per member)
+    """
+    __slots__ = ('rows', 'user_ids', 'nicks', 'roles', 'joined', 'statuses')
+
+    def __init__(self):
+        self.rows: Dict[int, int] = {}
+        self.user_ids = array('Q')
+        self.nicks: List[Optional[str]] = []
+        self.roles: List[array] = []
+        self.joined: List[Optional[str]] = []
+        self.statuses = array('B')
+
+    def row(self, user_id: int) -> int:
+        """
+        Get the row of a member, adding an empty row if they aren't stored yet
+        """
+        row = self.rows.get(user_id)
+        if row is None:
+            row = self.rows[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.nicks.append(None)
+            self.roles.append(_no_roles)
+            self.joined.append(None)
+            self.statuses.append(0)
+        return row
+
+    def remove(self, user_id: int) -> bool:
+        """
+        Remove a member, moving the last row into its place
+        """
+        row = self.rows.pop(user_id, None)
+        if row is None:
+            return False
+        last = len(self.user_ids)-1
+        if row != last:
+            moved = self.user_ids[last]
+            self.rows[moved] = row
+            self.user_ids[row] = moved
+            self.nicks[row] = self.nicks[last]
+            self.roles[row] = self.roles[last]
+            self.joined[row] = self.joined[last]
+            self.statuses[row] = self.statuses[last]
+        self.user_ids.pop()
+        self.nicks.pop()
+        self.roles.pop()
+        self.joined.pop()
+        self.statuses.pop()
+        return True
+
+
+class MemberStore(object):
+    """
+    A memory-compact store of guild members and their presences.\n
+    Members are kept column-wise per guild, role lists are arrays shared between every member with the same roles,
+    and each user is stored once no matter how many guilds they share.
+    Users and role sets are reference counted, and dropped once no member row uses them.
+    """
+
+    def __init__(self, entities: EntityStore = None):
+        """Create a member store
+
+        Args:
+            entities (EntityStore, optional): Store to keep the users in (shared with the user objects connections receive), instead of a store of its own. Defaults to None.
+        """
+        self.entities = entities
+        self.users: Dict[int, dict] = {}
+        self._guilds: Dict[int, _GuildMembers] = {}
+        self._role_sets: Dict[bytes, array] = {b'': _no_roles}
+        #The number of member rows (across all guilds) of each user, and using each role set
+        self._user_refs: Dict[int, int] = {}
+        self._role_refs: Dict[bytes, int] = {}
+
+    def _guild(self, guild_id: Snowflake) -> _GuildMembers:
+        guild_id = int(guild_id)
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _GuildMembers()
+        return guild
+
+    def _intern_user(self, user: dict) -> int:
+        """
+        Store (or update in place) the shared copy of a user, and return their id
+        """
+        user_id = int(user['id'])
+        user = {key: sys.intern(value) if isinstance(value, str) else value for key, value in user.items()}
+        if self.entities is not None:
+            # The member store is an owner of its users, like an account
+            self.entities.add('user', user, self)
+            return user_id
+        stored = self.users.get(user_id)
+        if stored is None:
+            stored = self.users[user_id] = {}
+        stored.update(user)
+        return user_id
+
+    def user(self, user_id: Snowflake) -> Optional[dict]:
+        """Get a stored user.
+
+        Args:
+            user_id (Snowflake): The user
+
+        Returns:
+            Optional[dict]: The user, or None if no stored member is them
+        """
+        if self.entities is not None:
+            return self.entities.get('user', user_id) if int(user_id) in self._user_refs else None
+        return self.users.get(int(user_id))
+
+    def _intern_roles(self, roles: List[Snowflake]) -> array:
+        """
+        Get the shared array for a set of role ids, counting a reference to it
+        """
+        role_ids = array('Q', sorted(int(role) for role in roles))
+        key = role_ids.tobytes()
+        if key:
+            self._role_refs[key] = self._role_refs.get(key, 0)+1
+        return self._role_sets.setdefault(key, role_ids)
+
+    def _release_roles(self, role_ids: array):
+        """
+        Drop a reference to a shared role set, forgetting it once unused (the empty set is kept)
+        """
+        key = role_ids.tobytes()
+        if not key:
+            return
+        refs = self._role_refs[key]-1
+        if refs:
+            self._role_refs[key] = refs
+        else:
+            del self._role_refs[key]
+            del self._role_sets[key]
+
+    def _release_row(self, guild: _GuildMembers, row: int):
+        """
+        Drop the references held by a member row (before it is removed)
+        """
+        self._release_roles(guild.roles[row])
+        user_id = guild.user_ids[row]
+        refs = self._user_refs[user_id]-1
+        if refs:
+            self._user_refs[user_id] = refs
+        else:
+            del self._user_refs[user_id]
+            if self.entities is not None:
+                self.entities.remove('user', user_id, self)
+            else:
+                del self.users[user_id]
+
+    def update_member(self, guild_id: Snowflake, member: dict):
+        """Add a member (as received from GUILD_MEMBERS_CHUNK/GUILD_MEMBER_ADD), or apply an update to one (GUILD_MEMBER_UPDATE).
+
+        Args:
+            guild_id (Snowflake): The guild of the member
+            member (dict): The member (or the changed fields of it). Must contain "user"
+        """
+        guild = self._guild(guild_id)
+        user_id = self._intern_user(member['user'])
+        if user_id not in guild.rows:
+            self._user_refs[user_id] = self._user_refs.get(user_id, 0)+1
+        row = guild.row(user_id)
+        if 'nick' in member:
+            guild.nicks[row] = member['nick']
+        if 'roles' in member:
+            roles = self._intern_roles(member['roles'])
+            self._release_roles(guild.roles[row])
+            guild.roles[row] = roles
+        if 'joined_at' in member:
+            guild.joined[row] = member['joined_at']
+
+    def add_members(self, guild_id: Snowflake, members: List[dict], presences: List[dict] = None):
+        """Add many members (and optionally their presences) at once, eg: a GUILD_MEMBERS_CHUNK.
+
+        Args:
+            guild_id (Snowflake): The guild of the members
+            members (List[dict]): The members
+            presences (List[dict], optional): The presences of the members. Defaults to None.
+        """
+        for member in members:
+            self.update_member(guild_id, member)
+        for presence in presences or ():
+            self.update_presence({**presence, 'guild_id': guild_id})
+
+    def remove_member(self, guild_id: Snowflake, user_id: Snowflake) -> bool:
+        """Remove a member (GUILD_MEMBER_REMOVE).
+
+        Args:
+            guild_id (Snowflake): The guild of the member
+            user_id (Snowflake): The user
+
+        Returns:
+            bool: Whether the member was stored
+        """
+        guild = self._guilds.get(int(guild_id))
+        row = guild.rows.get(int(user_id)) if guild else None
+        if row is None:
+            return False
+        self._release_row(guild, row)
+        guild.remove(int(user_id))
+        if not guild.rows:
+            del self._guilds[int(guild_id)]
+        return True
+
+    def update_presence(self, presence: dict):
+        """Apply a presence update (PRESENCE_UPDATE) to a member. Presences of members that aren't stored are ignored.
+
+        Args:
+            presence (dict): The presence. Must contain "user" (which may be partial) and "guild_id"
+        """
+        guild = self._guilds.get(int(presence['guild_id']))
+        user_id = int(presence['user']['id'])
+        if guild is None or user_id not in guild.rows:
+            return
+        if len(presence['user']) > 1:
+            self._intern_user(presence['user'])
+        if 'status' in presence:
+            guild.statuses[guild.rows[user_id]] = _status_codes.get(presence['status'], 0)
+
+    def remove_guild(self, guild_id: Snowflake):
+        """Forget every member of a guild.
+
+        Args:
+            guild_id (Snowflake): The guild
+        """
+        guild = self._guilds.pop(int(guild_id), None)
+        if guild is None:
+            return
+        for row in range(len(guild.user_ids)):
+            self._release_row(guild, row)
+
+    def count(self, guild_id: Snowflake) -> int:
+        """Get the number of stored members of a guild.
+
+        Args:
+            guild_id (Snowflake): The guild
+
+        Returns:
+            int: The number of members
+        """
+        guild = self._guilds.get(int(guild_id))
+        return len(guild.user_ids) if guild else 0
+
+    def _member(self, guild: _GuildMembers, row: int) -> dict:
+        return {
+            'user': self.user(guild.user_ids[row]),
+            'nick': guild.nicks[row],
+            'roles': [str(role) for role in guild.roles[row]],
+            'joined_at': guild.joined[row],
+            'status': statuses[guild.statuses[row]]
+        }
+
+    def get(self, guild_id: Snowflake, user_id: Snowflake) -> Optional[dict]:
+        """Get a member of a guild.
+
+        Args:
+            guild_id (Snowflake): The guild
+            user_id (Snowflake): The user
+
+        Returns:
+            Optional[dict]: The member ({user, nick, roles, joined_at, status}), or None if not stored
+        """
+        guild = self._guilds.get(int(guild_id))
+        if guild is None:
+            return None
+        row = guild.rows.get(int(user_id))
+        return self._member(guild, row) if row is not None else None
+
+    def members(self, guild_id: Snowflake) -> Iterator[dict]:
+        """Iterate over the stored members of a guild.
+
+        Args:
+            guild_id (Snowflake): The guild
+
+        Yields:
+            dict: Each member ({user, nick, roles, joined_at, status})
+        """
+        guild = self._guilds.get(int(guild_id))
+        if guild is None:
+            return
+        for row in range(len(guild.user_ids)):
+            yield self._member(guild, row)
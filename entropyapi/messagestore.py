@@ -0,0 +1,547 @@
+import os
+import json
+import mmap
+import struct
+import asyncio
+import threading
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional
+import daiquiri
+logger = daiquiri.getLogger('entropy.messagestore')
+from .utils import script_dir, make_dirs
+from .snowflake import Snowflake
+
+#Record header: message id, record kind, payload length
+_header = struct.Struct('<QBI')
+_MESSAGE = 0
+_EDIT = 1
+_DELETE = 2
+
+
+class _HandleCache(object):
+    """
+    Keeps track of the segments with open files/mmaps, closing the least recently used ones
+    once there are more than `max_open` (so many channels don't run the process out of file descriptors).\n
+    A segment is only closed if its channel's lock is free, so a handle is never closed while it is in use.
+    """
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._open: 'OrderedDict[_Segment, None]' = OrderedDict()
+
+    def touch(self, segment: '_Segment'):
+        """
+        Mark a segment's handles as just used (after opening them, or reading/writing through them)
+        """
+        with self._lock:
+            self._open[segment] = None
+            self._open.move_to_end(segment)
+            excess = len(self._open)-self.max_open
+            if excess <= 0:
+                return
+            for victim in list(self._open):
+                if excess <= 0:
+                    break
+                # Busy channels (including the caller's own) are skipped, and closed on a later touch
+                if victim is segment or not victim.lock.acquire(blocking=False):
+                    continue
+                try:
+                    victim._close_handles()
+                finally:
+                    victim.lock.release()
+                del self._open[victim]
+                excess -= 1
+
+    def forget(self, segment: '_Segment'):
+        with self._lock:
+            self._open.pop(segment, None)
+
+
+class _Segment(object):
+    """
+    One append-only file of message records.\n
+    Only the newest segment of a channel is written to, all others are read-only (except when compacted).
+    Its file/mmap are opened when needed, and may be closed again by the store's handle cache while idle.
+    """
+
+    def __init__(self, path: str, seq: int, lock: threading.Lock, handles: _HandleCache):
+        self.path = path
+        self.seq = seq
+        self.lock = lock  # The lock of the channel this segment belongs to
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.dead = 0  # Bytes of records that were edited/deleted since
+        self.tombstones = 0  # Bytes of delete records
+        self._handles = handles
+        self._file = None
+        self._mmap: mmap.mmap = None
+
+    def append(self, message_id: int, kind: int, payload: bytes) -> int:
+        """
+        Append a record, and return its offset
+        """
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._handles.touch(self)
+        offset = self.size
+        self._file.write(_header.pack(message_id, kind, len(payload))+payload)
+        self._file.flush()
+        self.size += _header.size+len(payload)
+        return offset
+
+    def read(self, offset: int) -> bytes:
+        """
+        Read the payload of the record at an offset
+        """
+        if self._mmap is None or offset+_header.size > len(self._mmap):
+            self._remap()
+        _, _, length = _header.unpack_from(self._mmap, offset)
+        if offset+_header.size+length > len(self._mmap):
+            self._remap()
+        self._handles.touch(self)
+        start = offset+_header.size
+        return self._mmap[start:start+length]
+
+    def records(self):
+        """
+        Iterate (offset, message id, kind, payload length) over all records in the segment
+        """
+        if not self.size:
+            return
+        self._remap()
+        offset = 0
+        while offset+_header.size <= len(self._mmap):
+            message_id, kind, length = _header.unpack_from(self._mmap, offset)
+            if offset+_header.size+length > len(self._mmap):
+                # Partly written record (eg: crashed mid-write), cut it off so appends start after the last whole record
+                logger.warn(f'Truncated record at {offset} in "{self.path}"')
+                self.close()
+                os.truncate(self.path, offset)
+                self.size = offset
+                return
+            yield offset, message_id, kind, length
+            offset += _header.size+length
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._handles.touch(self)
+
+    def close(self):
+        self._close_handles()
+        self._handles.forget(self)
+
+    def _close_handles(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class _Channel(object):
+    """
+    The segments and (sorted snowflake) index of one channel's messages.\n
+    The index is built from the segment files by load(), the first time the channel is used.
+    """
+
+    def __init__(self, path: str, handles: _HandleCache):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.segments: List[_Segment] = []
+        # Parallel arrays, sorted by message id
+        self.ids = array('Q')
+        self.locations: List[_Segment] = []
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self._handles = handles
+
+    def load(self):
+        """
+        Build the index from the segment files, if not done yet. Must hold the lock
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        make_dirs(os.path.join(self.path, ''))
+        names = sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+        for name in names:
+            segment = _Segment(os.path.join(self.path, name), int(name[:-4]), self.lock, self._handles)
+            self.segments.append(segment)
+            for offset, message_id, kind, length in segment.records():
+                if kind == _DELETE:
+                    segment.tombstones += _header.size+length
+                    self.remove(message_id)
+                else:
+                    self.put(message_id, segment, offset, length)
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def find(self, message_id: int) -> int:
+        """
+        Get the index position of a message id, or -1
+        """
+        i = bisect_left(self.ids, message_id)
+        if i < len(self.ids) and self.ids[i] == message_id:
+            return i
+        return -1
+
+    def put(self, message_id: int, segment: _Segment, offset: int, length: int):
+        """
+        Point the index at a new record for a message, marking the old one (if any) dead
+        """
+        i = bisect_left(self.ids, message_id)
+        if i < len(self.ids) and self.ids[i] == message_id:
+            self._mark_dead(i)
+            self.locations[i] = segment
+            self.offsets[i] = offset
+            self.lengths[i] = length
+            return
+        # Messages almost always arrive newest, so this is nearly always an append
+        self.ids.insert(i, message_id)
+        self.locations.insert(i, segment)
+        self.offsets.insert(i, offset)
+        self.lengths.insert(i, length)
+
+    def remove(self, message_id: int) -> bool:
+        """
+        Remove a message from the index, marking its record dead
+        """
+        i = self.find(message_id)
+        if i < 0:
+            return False
+        self._mark_dead(i)
+        del self.ids[i]
+        del self.locations[i]
+        del self.offsets[i]
+        del self.lengths[i]
+        return True
+
+    def _mark_dead(self, i: int):
+        self.locations[i].dead += _header.size+self.lengths[i]
+
+    def active(self, segment_size: int) -> _Segment:
+        """
+        Get the segment to append to, starting a new one if the current one is full
+        """
+        if not self.segments or self.segments[-1].size >= segment_size:
+            seq = self.segments[-1].seq+1 if self.segments else 0
+            self.segments.append(_Segment(os.path.join(self.path, f'{seq:08d}.seg'), seq, self.lock, self._handles))
+        return self.segments[-1]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class MessageStore(object):
+    """
+    A local, append-only store of messages.\n
+    Each channel's messages are kept in segment files, with a sorted snowflake index in memory for fast seeks and range reads.
+    Edits and deletes are appended as new records, and the space they waste is reclaimed by compaction.
+    """
+
+    def __init__(self, path: str = None, segment_size: int = 4*1024*1024, max_channel_bytes: int = 256*1024*1024,
+                 compact_ratio: float = 0.5, max_open_segments: int = 128):
+        """Create (or open) a message store
+
+        Args:
+            path (str, optional): The directory to keep messages in. Defaults to None (data/messages next to the script).
+            segment_size (int, optional): The size in bytes a segment grows to before a new one is started. Defaults to 4MB.
+            max_channel_bytes (int, optional): The size in bytes a channel can grow to before its oldest segments are deleted. Defaults to 256MB.
+            compact_ratio (float, optional): The fraction of a segment that must be wasted before it is compacted. Defaults to 0.5.
+            max_open_segments (int, optional): The number of segments that can have open files at once, the least recently used are closed. Defaults to 128.
+        """
+        self.path = path or os.path.join(script_dir(), 'data', 'messages')
+        self.segment_size = segment_size
+        self.max_channel_bytes = max_channel_bytes
+        self.compact_ratio = compact_ratio
+        self._channels: Dict[int, _Channel] = {}
+        self._channels_lock = threading.Lock()
+        self._handles = _HandleCache(max_open_segments)
+        self._compact_lock = threading.Lock()
+        self.compaction_task: asyncio.Task = None
+        logger.info(f'Opened message store "{self.path}"')
+
+    def _channel(self, channel_id: Snowflake, create: bool = True) -> Optional[_Channel]:
+        """
+        Get a (loaded) channel. Channels with nothing stored are only created if `create`, otherwise None is returned
+        """
+        channel_id = int(channel_id)
+        with self._channels_lock:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                path = os.path.join(self.path, str(channel_id))
+                if not create and not os.path.isdir(path):
+                    return None
+                channel = self._channels[channel_id] = _Channel(path, self._handles)
+        # Loaded under the channel's own lock, so other channels aren't held up meanwhile
+        with channel.lock:
+            channel.load()
+        return channel
+
+    def load(self):
+        """Load the index of every channel stored on disk. Channels are otherwise loaded the first time they are used,
+            so run this in a thread (eg: `await loop.run_in_executor(None, store.load)`) to keep that off the event loop.
+        """
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else ():
+            if name.isdigit():
+                self._channel(name, create=False)
+        logger.info(f'Loaded {len(self._channels)} channels from "{self.path}"')
+
+    def _append(self, channel: _Channel, message_id: int, kind: int, payload: bytes) -> tuple:
+        segment = channel.active(self.segment_size)
+        return segment, segment.append(message_id, kind, payload)
+
+    def add(self, message: dict):
+        """Add a message (as received from MESSAGE_CREATE) to the store.
+
+        Args:
+            message (dict): The message. Must contain "id" and "channel_id"
+        """
+        channel = self._channel(message['channel_id'])
+        payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+        message_id = int(message['id'])
+        with channel.lock:
+            kind = _EDIT if channel.find(message_id) >= 0 else _MESSAGE
+            segment, offset = self._append(channel, message_id, kind, payload)
+            channel.put(message_id, segment, offset, len(payload))
+            self._enforce_retention(channel)
+
+    def update(self, message: dict) -> Optional[dict]:
+        """Apply an edit (as received from MESSAGE_UPDATE, which may be partial) to a stored message.
+
+        Args:
+            message (dict): The changed fields of the message. Must contain "id" and "channel_id"
+
+        Returns:
+            Optional[dict]: The updated message, or None if the message isn't stored
+        """
+        old = self.get(message['channel_id'], message['id'])
+        if old is None:
+            return None
+        old.update(message)
+        self.add(old)
+        return old
+
+    def delete(self, channel_id: Snowflake, message_id: Snowflake) -> bool:
+        """Delete a message from the store.
+
+        Args:
+            channel_id (Snowflake): The channel of the message
+            message_id (Snowflake): The message
+
+        Returns:
+            bool: Whether the message was stored
+        """
+        channel = self._channel(channel_id, create=False)
+        if channel is None:
+            return False
+        message_id = int(message_id)
+        with channel.lock:
+            if not channel.remove(message_id):
+                return False
+            segment, _ = self._append(channel, message_id, _DELETE, b'')
+            segment.tombstones += _header.size
+        return True
+
+    def get(self, channel_id: Snowflake, message_id: Snowflake) -> Optional[dict]:
+        """Get a message from the store.
+
+        Args:
+            channel_id (Snowflake): The channel of the message
+            message_id (Snowflake): The message
+
+        Returns:
+            Optional[dict]: The message, or None if it isn't stored
+        """
+        channel = self._channel(channel_id, create=False)
+        if channel is None:
+            return None
+        with channel.lock:
+            i = channel.find(int(message_id))
+            if i < 0:
+                return None
+            return json.loads(channel.locations[i].read(channel.offsets[i]))
+
+    def history(self, channel_id: Snowflake, limit: int = 50, before: Snowflake = None, after: Snowflake = None,
+                around: Snowflake = None) -> List[dict]:
+        """Get a range of messages from a channel, like the REST "Get Channel Messages" endpoint.
+
+        Args:
+            channel_id (Snowflake): The channel
+            limit (int, optional): The maximum number of messages to get. Defaults to 50.
+            before (Snowflake, optional): Get messages before this id. Defaults to None.
+            after (Snowflake, optional): Get messages after this id. Defaults to None.
+            around (Snowflake, optional): Get messages around this id. Defaults to None.
+        If none of before/after/around are given, the newest messages are returned.
+
+        Returns:
+            List[dict]: The messages, newest first
+        """
+        channel = self._channel(channel_id, create=False)
+        if channel is None:
+            return []
+        with channel.lock:
+            count = len(channel.ids)
+            if around is not None:
+                i = bisect_left(channel.ids, int(around))
+                start = max(0, i-limit//2)
+                end = min(count, start+limit)
+            elif after is not None:
+                start = bisect_right(channel.ids, int(after))
+                end = min(count, start+limit)
+                if before is not None:
+                    end = min(end, bisect_left(channel.ids, int(before)))
+            else:
+                end = bisect_left(channel.ids, int(before)) if before is not None else count
+                start = max(0, end-limit)
+            return [json.loads(channel.locations[i].read(channel.offsets[i])) for i in range(end-1, start-1, -1)]
+
+    def _enforce_retention(self, channel: _Channel):
+        """
+        Delete a channel's oldest segments while it is larger than max_channel_bytes
+        """
+        while len(channel.segments) > 1 and channel.size > self.max_channel_bytes:
+            segment = channel.segments.pop(0)
+            keep = [i for i, location in enumerate(channel.locations) if location is not segment]
+            channel.ids = array('Q', (channel.ids[i] for i in keep))
+            channel.offsets = array('Q', (channel.offsets[i] for i in keep))
+            channel.lengths = array('I', (channel.lengths[i] for i in keep))
+            channel.locations = [channel.locations[i] for i in keep]
+            segment.close()
+            os.remove(segment.path)
+            logger.debug(f'Retention removed segment "{segment.path}"')
+
+    def _compact_segment(self, channel: _Channel, segment: _Segment):
+        """
+        Rewrite a segment with only its live records (and tombstones that may still hide older records).\n
+        The new file is built without holding the channel lock, so appends and reads carry on meanwhile.
+        The lock is only taken briefly to check which records are live, and to swap the new file in.
+        """
+        with channel.lock:
+            if segment not in channel.segments:
+                return
+            oldest = segment is channel.segments[0]
+        tmp_path = segment.path+'.compact'
+        copied = []  # (message id, old offset, new offset, payload length) of each message record copied
+        tombstones = 0
+        position = 0
+        # A mapping of our own, so readers remapping the segment can't close it under us
+        with open(segment.path, 'rb') as f:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with open(tmp_path, 'wb') as out:
+                offset = 0
+                while offset+_header.size <= len(source):
+                    # Check liveness a batch of records at a time, so the lock is never held for long
+                    batch = []
+                    with channel.lock:
+                        while offset+_header.size <= len(source) and len(batch) < 256:
+                            message_id, kind, length = _header.unpack_from(source, offset)
+                            i = channel.find(message_id)
+                            live = i >= 0 and channel.locations[i] is segment and channel.offsets[i] == offset
+                            if live or (kind == _DELETE and not oldest):
+                                batch.append((offset, message_id, kind, length))
+                            offset += _header.size+length
+                    for record_offset, message_id, kind, length in batch:
+                        out.write(source[record_offset:record_offset+_header.size+length])
+                        if kind == _DELETE:
+                            tombstones += _header.size+length
+                        else:
+                            copied.append((message_id, record_offset, position, length))
+                        position += _header.size+length
+        finally:
+            source.close()
+
+        with channel.lock:
+            if segment not in channel.segments:
+                # Removed by retention meanwhile
+                os.remove(tmp_path)
+                return
+            old_size = segment.size
+            dead = 0
+            # Records only ever go from live to dead, so anything not copied is still dead.
+            # Copied records edited/deleted during the rewrite are dead in the new file too
+            for message_id, old_offset, new_offset, length in copied:
+                i = channel.find(message_id)
+                if i >= 0 and channel.locations[i] is segment and channel.offsets[i] == old_offset:
+                    channel.offsets[i] = new_offset
+                else:
+                    dead += _header.size+length
+            segment.close()
+            os.replace(tmp_path, segment.path)
+            segment.size = position
+            segment.dead = dead
+            segment.tombstones = tombstones
+        logger.debug(f'Compacted "{segment.path}" from {old_size} to {position} bytes')
+
+    def _drop_empty_segments(self, channel: _Channel) -> bool:
+        """
+        Delete segments that compaction emptied (other than the one being appended to),
+        so the next segment can become the oldest and have its tombstones reclaimed
+        """
+        dropped = False
+        with channel.lock:
+            for segment in channel.segments[:-1]:
+                if segment.size == 0:
+                    channel.segments.remove(segment)
+                    segment.close()
+                    os.remove(segment.path)
+                    dropped = True
+                    logger.debug(f'Removed empty segment "{segment.path}"')
+        return dropped
+
+    def compact(self):
+        """Compact every segment (except the ones being appended to) that is wasting enough space.
+        """
+        with self._channels_lock:
+            channels = list(self._channels.values())
+        with self._compact_lock:
+            for channel in channels:
+                # Dropping an emptied oldest segment can make the next one's tombstones reclaimable, so go again
+                while True:
+                    with channel.lock:
+                        oldest = channel.segments[0] if channel.segments else None
+                        candidates = [segment for segment in channel.segments[:-1] if segment.size and
+                                      segment.dead+(segment.tombstones if segment is oldest else 0) >= segment.size*self.compact_ratio]
+                    for segment in candidates:
+                        self._compact_segment(channel, segment)
+                    if not self._drop_empty_segments(channel) or not candidates:
+                        break
+
+    def start_compaction(self, loop: asyncio.AbstractEventLoop = None, interval: float = 60.0):
+        """Start compacting in the background (in a thread, every `interval` seconds), if not already started.
+
+        Args:
+            loop (asyncio.AbstractEventLoop, optional): The async loop to use. Defaults to None (the current loop).
+            interval (float, optional): The time in seconds between compactions. Defaults to 60.0.
+        """
+        if self.compaction_task and not self.compaction_task.done():
+            return
+        loop = loop or asyncio.get_event_loop()
+
+        async def compaction_loop():
+            while True:
+                await asyncio.sleep(interval)
+                await loop.run_in_executor(None, self.compact)
+        self.compaction_task = loop.create_task(compaction_loop(), name='entropy-message-compaction')
+
+    def close(self):
+        """Stop compacting, and close all open segment files.
+        """
+        if self.compaction_task:
+            self.compaction_task.cancel()
+        with self._channels_lock:
+            for channel in self._channels.values():
+                with channel.lock:
+                    channel.close()
+            self._channels.clear()
@@ -0,0 +1,617 @@
+import os
+import re
+import math
+import heapq
+import mmap
+import pickle
+import time
+import struct
+import asyncio
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+import daiquiri
+logger = daiquiri.getLogger('entropy.search')
+from .utils import script_dir, make_dirs
+from .snowflake import Snowflake
+
+_token_re = re.compile(r'\w+')
+#A query is made of "quoted phrases", prefix* terms and plain terms
+_query_re = re.compile(r'"([^"]*)"|(\S+)')
+_length = struct.Struct('<Q')
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into the (lowercase) terms that are indexed.
+
+    Args:
+        text (str): The text
+
+    Returns:
+        List[str]: The terms, in order
+    """
+    return _token_re.findall(text.lower())
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_postings(postings: Dict[int, List[int]]) -> bytes:
+    """
+    Encode the postings of one term as varints: (message id delta, position count, position deltas...) for each message, in id order
+    """
+    out = bytearray()
+    last_id = 0
+    for message_id in sorted(postings):
+        positions = postings[message_id]
+        _write_varint(out, message_id-last_id)
+        _write_varint(out, len(positions))
+        last_position = 0
+        for position in positions:
+            _write_varint(out, position-last_position)
+            last_position = position
+        last_id = message_id
+    return bytes(out)
+
+
+def _decode_postings(buf, pos: int, end: int) -> Dict[int, List[int]]:
+    postings = {}
+    message_id = 0
+    while pos < end:
+        delta, pos = _read_varint(buf, pos)
+        message_id += delta
+        count, pos = _read_varint(buf, pos)
+        positions = []
+        position = 0
+        for _ in range(count):
+            delta, pos = _read_varint(buf, pos)
+            position += delta
+            positions.append(position)
+        postings[message_id] = positions
+    return postings
+
+
+class _LiveSegment(object):
+    """
+    The in-memory segment new messages are indexed into, until it is flushed to disk.\n
+    While it is being flushed it is frozen: it stays searchable, but removals are only recorded in `killed`.
+    """
+
+    def __init__(self, gen: int):
+        self.gen = gen
+        self.index: Dict[str, Dict[int, List[int]]] = {}
+        self.docs: Dict[int, Tuple[int, int]] = {}
+        self.killed = set()
+        self.started: float = None  # When the first message was indexed into it (time.monotonic())
+        self._terms_of: Dict[int, set] = {}
+        self._sorted_terms: List[str] = None
+
+    def add(self, message_id: int, channel_id: int, author_id: int, terms: List[str]):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.docs[message_id] = (channel_id, author_id)
+        self._terms_of[message_id] = set(terms)
+        for position, term in enumerate(terms):
+            postings = self.index.get(term)
+            if postings is None:
+                postings = self.index[term] = {}
+                self._sorted_terms = None
+            postings.setdefault(message_id, []).append(position)
+
+    def discard(self, message_id: int) -> bool:
+        """
+        Remove a message (from the active segment), along with its postings
+        """
+        if self.docs.pop(message_id, None) is None:
+            return False
+        for term in self._terms_of.pop(message_id):
+            postings = self.index[term]
+            del postings[message_id]
+            if not postings:
+                del self.index[term]
+                self._sorted_terms = None
+        return True
+
+    def kill(self, message_id: int) -> bool:
+        """
+        Remove a message from the (frozen) segment
+        """
+        if message_id not in self.docs or message_id in self.killed:
+            return False
+        self.killed.add(message_id)
+        return True
+
+    def doc(self, message_id: int) -> Optional[Tuple[int, int]]:
+        if message_id in self.killed:
+            return None
+        return self.docs.get(message_id)
+
+    def live_count(self) -> int:
+        return len(self.docs)-len(self.killed)
+
+    def postings(self, term: str) -> Dict[int, List[int]]:
+        return self.index.get(term, {})
+
+    def terms(self) -> List[str]:
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.index)
+        return self._sorted_terms
+
+
+class _DiskSegment(object):
+    """
+    A flushed (immutable) segment, read through mmap: the encoded postings of each term, then a pickled header
+    (term offsets, and the id/channel/author arrays of its messages), then the length of the header.\n
+    Removed messages are flagged in `dead`. Segments are reference counted, so one replaced by a merge
+    is only closed once no search is still reading it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.gen = int(os.path.basename(path)[:8])
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = len(self._mmap)-_length.size
+        header_length, = _length.unpack_from(self._mmap, header_end)
+        header = pickle.loads(self._mmap[header_end-header_length:header_end])
+        self.offsets: Dict[str, Tuple[int, int]] = header['terms']
+        self.replaces: List[str] = header['replaces']
+        self._sorted_terms = sorted(self.offsets)
+        self.ids = array('Q')
+        self.ids.frombytes(header['ids'])
+        self.channels = array('Q')
+        self.channels.frombytes(header['channels'])
+        self.authors = array('Q')
+        self.authors.frombytes(header['authors'])
+        self.dead = bytearray(len(self.ids))
+        self._refs = 0
+        self._retired = False
+        self._delete = False
+
+    @staticmethod
+    def write(path: str, terms: Iterable[Tuple[str, Dict[int, List[int]]]], docs: Iterable[Tuple[int, int, int]],
+              replaces: List[str] = ()):
+        """
+        Write a segment file, streaming the postings of each term (through a temporary file, so a crash never leaves half a segment)
+
+        `terms` (term, postings) in term order\n
+        `docs` (message id, channel id, author id) in id order\n
+        `replaces` The file names of the segments this one was merged from
+        """
+        offsets = {}
+        ids, channels, authors = array('Q'), array('Q'), array('Q')
+        for message_id, channel_id, author_id in docs:
+            ids.append(message_id)
+            channels.append(channel_id)
+            authors.append(author_id)
+        with open(path+'.tmp', 'wb') as f:
+            position = 0
+            for term, postings in terms:
+                if not postings:
+                    continue
+                encoded = _encode_postings(postings)
+                f.write(encoded)
+                offsets[term] = (position, len(encoded))
+                position += len(encoded)
+            header = pickle.dumps({'terms': offsets, 'replaces': list(replaces), 'ids': ids.tobytes(),
+                                   'channels': channels.tobytes(), 'authors': authors.tobytes()},
+                                  protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(header)
+            f.write(_length.pack(len(header)))
+        os.replace(path+'.tmp', path)
+
+    def _row(self, message_id: int) -> int:
+        i = bisect_left(self.ids, message_id)
+        if i < len(self.ids) and self.ids[i] == message_id:
+            return i
+        return -1
+
+    def doc(self, message_id: int) -> Optional[Tuple[int, int]]:
+        row = self._row(message_id)
+        if row < 0 or self.dead[row]:
+            return None
+        return self.channels[row], self.authors[row]
+
+    def kill(self, message_id: int) -> bool:
+        row = self._row(message_id)
+        if row < 0 or self.dead[row]:
+            return False
+        self.dead[row] = 1
+        return True
+
+    def live_count(self) -> int:
+        return len(self.ids)-self.dead.count(1)
+
+    def docs(self, exclude: set = ()) -> Iterable[Tuple[int, int, int]]:
+        """
+        Iterate over the (message id, channel id, author id) of the messages, in id order
+        """
+        for row, message_id in enumerate(self.ids):
+            if message_id not in exclude:
+                yield message_id, self.channels[row], self.authors[row]
+
+    def postings(self, term: str) -> Dict[int, List[int]]:
+        location = self.offsets.get(term)
+        if location is None:
+            return {}
+        return _decode_postings(self._mmap, location[0], location[0]+location[1])
+
+    def terms(self) -> List[str]:
+        return self._sorted_terms
+
+    def acquire(self):
+        self._refs += 1
+
+    def release(self):
+        self._refs -= 1
+        if self._retired and not self._refs:
+            self._close()
+
+    def retire(self, delete: bool = False):
+        """
+        Close the segment (deleting its file if `delete`) once nothing is reading it
+        """
+        self._retired = True
+        self._delete = delete
+        if not self._refs:
+            self._close()
+
+    def _close(self):
+        self._mmap.close()
+        if self._delete:
+            os.remove(self.path)
+
+
+class SearchIndex(object):
+    """
+    An incremental full-text (inverted) index of messages.\n
+    Messages are indexed into an in-memory segment, which is flushed to disk once large enough.
+    Disk segments of similar size are merged in the background (tiered, so each message is only rewritten a few times).
+    Edits and deletes take effect immediately by flagging the old copy dead, and are dropped when segments are merged.
+    """
+
+    def __init__(self, path: str = None, flush_docs: int = 10000, merge_factor: int = 8, flush_age: float = 300.0):
+        """Create (or open) a search index
+
+        Args:
+            path (str, optional): The directory to keep the index in. Defaults to None (data/search next to the script).
+            flush_docs (int, optional): The number of messages indexed in memory before they are flushed to a disk segment. Defaults to 10000.
+            merge_factor (int, optional): The number of similar sized disk segments there can be before they are merged into one. Defaults to 8.
+            flush_age (float, optional): The time in seconds messages are kept only in memory before they are flushed, however few there are. Defaults to 300.0.
+        """
+        self.path = path or os.path.join(script_dir(), 'data', 'search')
+        self.flush_docs = flush_docs
+        self.merge_factor = merge_factor
+        self.flush_age = flush_age
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self.merge_task: asyncio.Task = None
+        make_dirs(os.path.join(self.path, ''))
+        # (message id, segment generation) of every message removed from a disk segment
+        self._kills_path = os.path.join(self.path, 'kills.log')
+        # Messages removed while a merge is running, to remove from its output too
+        self._merge_kills: List[int] = None
+        segments = [_DiskSegment(os.path.join(self.path, name))
+                    for name in sorted(os.listdir(self.path)) if name.endswith('.idx')]
+        # A crash after a merge was written, but before its inputs were deleted, leaves both behind
+        replaced = {name for segment in segments for name in segment.replaces}
+        for segment in segments:
+            if os.path.basename(segment.path) in replaced:
+                segment.retire(delete=True)
+        self._segments: List = sorted((segment for segment in segments if not segment._retired), key=lambda segment: segment.gen)
+        by_gen = {segment.gen: segment for segment in self._segments}
+        for message_id, gen in self._read_kills():
+            if gen in by_gen:
+                by_gen[gen].kill(message_id)
+        self._live = _LiveSegment(self._segments[-1].gen+1 if self._segments else 0)
+        logger.info(f'Opened search index "{self.path}" ({len(self)} messages)')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(segment.live_count() for segment in self._segments)+self._live.live_count()
+
+    def _read_kills(self) -> List[Tuple[int, int]]:
+        kills = array('Q')
+        if os.path.exists(self._kills_path):
+            with open(self._kills_path, 'rb') as f:
+                data = f.read()
+            kills.frombytes(data[:len(data)-len(data) % (2*kills.itemsize)])
+        return list(zip(kills[::2], kills[1::2]))
+
+    def _log_kill(self, message_id: int, gen: int):
+        with open(self._kills_path, 'ab') as f:
+            f.write(array('Q', (message_id, gen)).tobytes())
+
+    def _kill(self, message_id: int) -> bool:
+        """
+        Remove the current copy of a message, wherever it is. Must hold the lock
+        """
+        if self._live.discard(message_id):
+            return True
+        for segment in reversed(self._segments):
+            if segment.kill(message_id):
+                self._log_kill(message_id, segment.gen)
+                if self._merge_kills is not None:
+                    self._merge_kills.append(message_id)
+                return True
+        return False
+
+    def _lookup(self, message_id: int) -> Optional[Tuple[int, int]]:
+        """
+        Get the (channel id, author id) of the current copy of a message. Must hold the lock
+        """
+        for segment in [self._live]+self._segments[::-1]:
+            doc = segment.doc(message_id)
+            if doc is not None:
+                return doc
+        return None
+
+    def add(self, message: dict):
+        """Index a message (as received from MESSAGE_CREATE). Indexing a message again replaces it.
+
+        Args:
+            message (dict): The message. Must contain "id", "channel_id", "author" and "content"
+        """
+        message_id = int(message['id'])
+        terms = tokenize(message.get('content') or '')
+        with self._lock:
+            self._kill(message_id)
+            self._live.add(message_id, int(message['channel_id']), int(message['author']['id']), terms)
+
+    def update(self, message: dict):
+        """Re-index an edited message (as received from MESSAGE_UPDATE, which may be partial).
+        Updates without new content, or for messages that were never indexed, are ignored.
+
+        Args:
+            message (dict): The changed fields of the message. Must contain "id"
+        """
+        if 'content' not in message:
+            return
+        with self._lock:
+            doc = self._lookup(int(message['id']))
+        if doc is None:
+            return
+        channel_id, author_id = doc
+        self.add({'id': message['id'], 'channel_id': channel_id, 'author': {'id': author_id}, 'content': message['content']})
+
+    def delete(self, message_id: Snowflake):
+        """Remove a message from the index.
+
+        Args:
+            message_id (Snowflake): The message
+        """
+        with self._lock:
+            self._kill(int(message_id))
+
+    def search(self, query: str, channel_id: Snowflake = None, author_id: Snowflake = None,
+               after: Snowflake = None, before: Snowflake = None, limit: int = 25) -> List[int]:
+        """Search the index. All parts of the query must match.
+
+        Args:
+            query (str): The query. Plain terms, prefix* terms and "quoted phrases" can be mixed.
+            channel_id (Snowflake, optional): Only match messages in this channel. Defaults to None.
+            author_id (Snowflake, optional): Only match messages by this user. Defaults to None.
+            after (Snowflake, optional): Only match messages after this id (see snowflake.time_snowflake for times). Defaults to None.
+            before (Snowflake, optional): Only match messages before this id. Defaults to None.
+            limit (int, optional): The maximum number of results. Defaults to 25.
+
+        Returns:
+            List[int]: The ids of the matching messages, newest first
+        """
+        clauses = []
+        for phrase, word in _query_re.findall(query):
+            if word.endswith('*') and tokenize(word):
+                clauses.append(('prefix', tokenize(word)[0]))
+            else:
+                terms = tokenize(phrase or word)
+                if len(terms) == 1:
+                    clauses.append(('term', terms[0]))
+                elif terms:
+                    clauses.append(('phrase', terms))
+        if not clauses:
+            return []
+        channel_id = int(channel_id) if channel_id is not None else None
+        author_id = int(author_id) if author_id is not None else None
+        after = int(after) if after is not None else None
+        before = int(before) if before is not None else None
+
+        with self._lock:
+            segments = self._segments+[self._live]
+            disk_segments = [segment for segment in segments if isinstance(segment, _DiskSegment)]
+            for segment in disk_segments:
+                segment.acquire()
+        results = set()
+        try:
+            for segment in segments:
+                for message_id in self._match(segment, clauses):
+                    if (after is not None and message_id <= after) or (before is not None and message_id >= before):
+                        continue
+                    doc = segment.doc(message_id)
+                    if doc is None:
+                        continue  # Deleted, or a newer version is in another segment
+                    if channel_id is not None and doc[0] != channel_id:
+                        continue
+                    if author_id is not None and doc[1] != author_id:
+                        continue
+                    results.add(message_id)
+        finally:
+            with self._lock:
+                for segment in disk_segments:
+                    segment.release()
+        return sorted(results, reverse=True)[:limit]
+
+    @staticmethod
+    def _match(segment, clauses: list) -> Iterable[int]:
+        """
+        Get the ids of the messages in a segment matching every clause
+        """
+        matched = None
+        for kind, value in sorted(clauses, key=lambda clause: clause[0] == 'prefix'):
+            if kind == 'term':
+                ids = set(segment.postings(value))
+            elif kind == 'prefix':
+                terms = segment.terms()
+                ids = set()
+                i = bisect_left(terms, value)
+                while i < len(terms) and terms[i].startswith(value):
+                    ids.update(segment.postings(terms[i]))
+                    i += 1
+            else:
+                postings = [segment.postings(term) for term in value]
+                ids = set(postings[0]).intersection(*postings[1:])
+                ids = {message_id for message_id in ids
+                       if any(all(start+offset in postings[offset][message_id] for offset in range(1, len(postings)))
+                              for start in postings[0][message_id])}
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                return ()
+        return matched
+
+    def flush(self):
+        """Write the in-memory segment to disk (if it has anything in it).
+        """
+        with self._merge_lock:
+            with self._lock:
+                live = self._live
+                if not live.docs:
+                    return
+                self._live = _LiveSegment(live.gen+1)
+                # Keep the frozen segment searchable until its disk copy replaces it
+                self._segments.append(live)
+            path = os.path.join(self.path, f'{live.gen:08d}.idx')
+            _DiskSegment.write(path, ((term, live.index[term]) for term in sorted(live.index)),
+                               ((message_id,)+live.docs[message_id] for message_id in sorted(live.docs)))
+            segment = _DiskSegment(path)
+            with self._lock:
+                # Removed while being written (already logged under this generation)
+                for message_id in live.killed:
+                    segment.kill(message_id)
+                self._segments[self._segments.index(live)] = segment
+            logger.debug(f'Flushed {segment.live_count()} messages to "{path}"')
+
+    def _tier(self, segment: '_DiskSegment') -> int:
+        size = len(segment.ids)
+        if size <= self.flush_docs:
+            return 0
+        return int(math.log(size/self.flush_docs, self.merge_factor))
+
+    def merge(self):
+        """Merge disk segments of similar size, while any size tier has at least merge_factor of them.
+        Removed (edited/deleted) messages are dropped from the merged segment.
+        """
+        with self._merge_lock:
+            while True:
+                with self._lock:
+                    tiers: Dict[int, List[_DiskSegment]] = {}
+                    for segment in self._segments:
+                        tiers.setdefault(self._tier(segment), []).append(segment)
+                    full = [tier for tier in sorted(tiers) if len(tiers[tier]) >= self.merge_factor]
+                    if not full:
+                        return
+                    inputs = sorted(tiers[full[0]], key=lambda segment: len(segment.ids))[:self.merge_factor]
+                    self._merge_kills = []
+                self._merge_segments(inputs)
+
+    def _merge_segments(self, inputs: List['_DiskSegment']):
+        """
+        Stream the live postings of some segments into one new segment, and swap it in for them
+        """
+        # The merged segment takes the newest generation of its inputs
+        gen = max(segment.gen for segment in inputs)
+        serial = 0
+        while os.path.exists(os.path.join(self.path, f'{gen:08d}m{serial}.idx')):
+            serial += 1
+        path = os.path.join(self.path, f'{gen:08d}m{serial}.idx')
+        # Snapshot what is dead now, anything removed later is in self._merge_kills
+        dead = []
+        for segment in inputs:
+            flags = bytes(segment.dead)
+            dead.append({segment.ids[row] for row in range(len(flags)) if flags[row]} if 1 in flags else set())
+
+        def merged_terms():
+            last = None
+            for term in heapq.merge(*(segment.terms() for segment in inputs)):
+                if term == last:
+                    continue
+                last = term
+                postings = {}
+                for segment, segment_dead in zip(inputs, dead):
+                    for message_id, positions in segment.postings(term).items():
+                        if message_id not in segment_dead:
+                            postings[message_id] = positions
+                yield term, postings
+
+        docs = heapq.merge(*(segment.docs(segment_dead) for segment, segment_dead in zip(inputs, dead)))
+        _DiskSegment.write(path, merged_terms(), docs, [os.path.basename(segment.path) for segment in inputs])
+        merged = _DiskSegment(path)
+        with self._lock:
+            for message_id in self._merge_kills:
+                if merged.kill(message_id):
+                    self._log_kill(message_id, merged.gen)
+            self._merge_kills = None
+            self._segments = sorted([segment for segment in self._segments if segment not in inputs]+[merged],
+                                    key=lambda segment: segment.gen)
+            for segment in inputs:
+                segment.retire(delete=True)
+            # Kills of the merged-away generations are now either dropped from the merged segment or logged again for it
+            gens = {segment.gen for segment in self._segments}
+            kills = array('Q')
+            for message_id, kill_gen in self._read_kills():
+                if kill_gen in gens:
+                    kills.extend((message_id, kill_gen))
+            # Through a temporary file, so a crash never loses the kills already logged
+            with open(self._kills_path+'.tmp', 'wb') as f:
+                f.write(kills.tobytes())
+            os.replace(self._kills_path+'.tmp', self._kills_path)
+        logger.debug(f'Merged {len(inputs)} segments into "{path}" ({merged.live_count()} messages)')
+
+    def start_merging(self, loop: asyncio.AbstractEventLoop = None, interval: float = 30.0):
+        """Start flushing and merging segments in the background (in a thread, every `interval` seconds), if not already started.
+
+        Args:
+            loop (asyncio.AbstractEventLoop, optional): The async loop to use. Defaults to None (the current loop).
+            interval (float, optional): The time in seconds between checks. Defaults to 30.0.
+        """
+        if self.merge_task and not self.merge_task.done():
+            return
+        loop = loop or asyncio.get_event_loop()
+
+        def maintain():
+            live = self._live
+            if len(live.docs) >= self.flush_docs or (live.docs and time.monotonic()-live.started >= self.flush_age):
+                self.flush()
+            self.merge()
+
+        async def merge_loop():
+            while True:
+                await asyncio.sleep(interval)
+                await loop.run_in_executor(None, maintain)
+        self.merge_task = loop.create_task(merge_loop(), name='entropy-search-merge')
+
+    def close(self):
+        """Stop merging, flush the in-memory segment and close all segment files (once no search is reading them).
+        """
+        if self.merge_task:
+            self.merge_task.cancel()
+        self.flush()
+        with self._lock:
+            for segment in self._segments:
+                segment.retire()
+            self._segments = []
@@ -0,0 +1,141 @@
+from datetime import datetime, timezone
+from typing import Dict, Iterable, NamedTuple, Union
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, batch functions fall back to lists
+    np = None
+
+#See snowflake format here https://discord.com/developers/docs/reference#snowflakes
+DISCORD_EPOCH = 1420070400000
+
+Snowflake = Union[int, str]
+
+
+class SnowflakeFields(NamedTuple):
+    """The fields packed into a snowflake
+    """
+    timestamp: int  # Milliseconds since the unix epoch
+    worker_id: int
+    process_id: int
+    increment: int
+
+
+def snowflake_time(snowflake: Snowflake) -> datetime:
+    """Get the time a snowflake was created at.
+
+    Args:
+        snowflake (Snowflake): The snowflake (as an int or string)
+
+    Returns:
+        datetime: The (UTC) creation time
+    """
+    return datetime.fromtimestamp(((int(snowflake) >> 22)+DISCORD_EPOCH)/1000, tz=timezone.utc)
+
+
+def time_snowflake(time: datetime, high: bool = False) -> int:
+    """Create the lowest (or highest) snowflake possible for a time. Useful for comparing against/filtering by time.
+
+    Args:
+        time (datetime): The time. Naive datetimes are treated as local time.
+        high (bool, optional): Whether to create the highest snowflake for the millisecond, instead of the lowest. Defaults to False.
+
+    Returns:
+        int: The snowflake
+    """
+    ms = int(time.timestamp()*1000)-DISCORD_EPOCH
+    return (ms << 22)+((1 << 22)-1 if high else 0)
+
+
+def snowflake_fields(snowflake: Snowflake) -> SnowflakeFields:
+    """Split a snowflake into its fields.
+
+    Args:
+        snowflake (Snowflake): The snowflake (as an int or string)
+
+    Returns:
+        SnowflakeFields: The timestamp, worker id, process id and increment of the snowflake
+    """
+    snowflake = int(snowflake)
+    return SnowflakeFields((snowflake >> 22)+DISCORD_EPOCH, (snowflake >> 17) & 0x1F,
+                           (snowflake >> 12) & 0x1F, snowflake & 0xFFF)
+
+
+def snowflake_array(snowflakes: Iterable[Snowflake]):
+    """Convert many snowflakes (ints or strings) to integers at once.
+
+    Args:
+        snowflakes (Iterable[Snowflake]): The snowflakes
+
+    Returns:
+        numpy.ndarray or List[int]: An int64 array if numpy is installed, otherwise a list of ints
+    """
+    if np is None:
+        return [int(s) for s in snowflakes]
+    if isinstance(snowflakes, np.ndarray):
+        return snowflakes.astype(np.int64, copy=False)
+    return np.fromiter(map(int, snowflakes), dtype=np.int64)
+
+
+def snowflake_timestamps(snowflakes: Iterable[Snowflake]):
+    """Get the creation time of many snowflakes at once.
+
+    Args:
+        snowflakes (Iterable[Snowflake]): The snowflakes
+
+    Returns:
+        numpy.ndarray or List[int]: The creation times in milliseconds since the unix epoch
+    """
+    snowflakes = snowflake_array(snowflakes)
+    if np is None:
+        return [(s >> 22)+DISCORD_EPOCH for s in snowflakes]
+    return (snowflakes >> 22)+DISCORD_EPOCH
+
+
+def snowflake_buckets(snowflakes: Iterable[Snowflake], bucket_ms: int):
+    """Bucket many snowflakes by creation time, eg: by day with bucket_ms=86400000.
+
+    Args:
+        snowflakes (Iterable[Snowflake]): The snowflakes
+        bucket_ms (int): The size of each bucket in milliseconds
+
+    Returns:
+        numpy.ndarray or List[int]: The bucket number of each snowflake (creation time in ms // bucket_ms)
+    """
+    timestamps = snowflake_timestamps(snowflakes)
+    if np is None:
+        return [t//bucket_ms for t in timestamps]
+    return timestamps//bucket_ms
+
+
+def sort_snowflakes(snowflakes: Iterable[Snowflake]):
+    """Sort many snowflakes (oldest first), as integers.
+
+    Args:
+        snowflakes (Iterable[Snowflake]): The snowflakes
+
+    Returns:
+        numpy.ndarray or List[int]: The sorted snowflakes
+    """
+    snowflakes = snowflake_array(snowflakes)
+    if np is None:
+        return sorted(snowflakes)
+    return np.sort(snowflakes)
+
+
+def snowflake_range(start: datetime = None, end: datetime = None) -> Dict[str, str]:
+    """Create the "after"/"before" query parameters for a time range [start, end).
+        Bounds at or before the Discord epoch are clamped to it (the API rejects negative snowflakes).
+
+    Args:
+        start (datetime, optional): The start of the range (inclusive). Defaults to None (no lower bound).
+        end (datetime, optional): The end of the range (exclusive). Defaults to None (no upper bound).
+
+    Returns:
+        Dict[str, str]: The parameters, eg: {"after": "...", "before": "..."}
+    """
+    params = {}
+    if start is not None:
+        params['after'] = str(max(0, time_snowflake(start)-1))
+    if end is not None:
+        params['before'] = str(max(0, time_snowflake(end)))
+    return params
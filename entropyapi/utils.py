@@ -1,6 +1,7 @@
 import datetime
 import os,errno
 import asyncio
+import time
 from threading import Timer
 import platform
 def fmt_time(delta: datetime.timedelta):
@@ -103,4 +104,28 @@ class RepeatedTimer(object):
     def stop(self):
         if self.is_running:
             self._timer.cancel()
-            self.is_running = False
\ No newline at end of file
+            self.is_running = False
+
+
+class ConnectLimiter(object):
+    """
+    Spaces out connection attempts so that no two start within `interval` seconds of each other.\n
+    Shared between many gateways so that (re)connecting accounts are staggered instead of all at once.\n
+    `interval` - The minimum number of seconds between connection attempts
+    """
+    def __init__(self, interval:float=1.0):
+        self.interval = interval
+        self._lock: asyncio.Lock = None
+        self._last = 0.0
+
+    async def wait(self):
+        """
+        Wait until a connection attempt may be made.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            delay = self._last+self.interval-time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last = time.monotonic()